@@ -1,39 +1,130 @@
 # flake8: noqa
-import sys
-
-from hprint import hprint
-
-from . import stringutils
-from . import threadutils
-from . import inspectutils
-from . import commutils
-from . import osutils
-from . import logutils
-from . import netutils
-from . import funcutils
-from . import dateutils
-from . import datautils
-from . import dbgutils
-from . import dsutils
-from . import urlutils
-from . import cryptutils
-from . import objutils
-from . import asyncutils
-from . import sqliteutils
+import os
+import importlib
 
 
 CLICK_CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
-__all__ = [
-    'CLICK_CONTEXT_SETTINGS',
-    'hprint',
-]
-
-for name, module in globals().copy().items():
-    if name.startswith('__'):
-        continue
-    if isinstance(module, type(sys)) and name.endswith('utils') and hasattr(module, '__all__') and module.__all__:
-        for item in module.__all__:
-            if item not in __all__:
-                globals()[item] = getattr(module, item)
-                __all__.append(item)
+# Submodule -> exported names, in the order they are listed in each
+# submodule's ``__all__``.  Attributes are resolved lazily (PEP 562) so that
+# ``from qqutils import pget`` only imports ``qqutils.dsutils``.
+# Keep this table in sync with the submodules (tests/test_init.py checks it).
+_EXPORTS = {
+    'hprint': (
+        'hprint',
+    ),
+    '.stringutils': (
+        'style', 'white', 'green', 'red', 'yellow', 'blue', 'cyan', 'magenta', 'bright_black',
+        'bold', 'underline', 'color_cycler', 'format_bytes', 'print_markdown', 'print_html',
+    ),
+    '.threadutils': (
+        'create_thread_pool', 'submit_daemon_thread', 'submit_thread', 'submit_thread_and_wait',
+        'submit_thread_and_wait_with_timeout', 'submit_thread_with_callback', 'wait_forever',
+    ),
+    '.inspectutils': (
+        'get_source',
+    ),
+    '.commutils': (
+        'send_mail',
+    ),
+    '.funcutils': (
+        'cached', 'run_click_command', 'run_click_command_with_obj', 'retry_with_exponential_backoff',
+        'synchronized', 'deprecated',
+    ),
+    '.osutils': (
+        'bye', 'goodbye', 'run_script', 'as_root', 'is_root', 'switch_dir', 'tmpdir', 'temp_dir',
+        'temp_file', 'from_cwd', 'from_module', 'write_to_clipboard', 'prompt', 'confirm', 'pause',
+        'add_suffix', 'modify_extension', 'from_path_str', 'under_home', 'backup', 'normalize_path',
+        'random_string', 'os_open_file', 'load_dotenv',
+    ),
+    '.logutils': (
+        'setup_icecream', 'pfatal', 'pdebug', 'pinfo', 'pwarning', 'perror', 'pstderr',
+        'configure_logging', 'install_print_with_flush', 'LoggerAdapter', 'sneaky',
+    ),
+    '.netutils': (
+        'disable_urllib3_warnings', 'download', 'upload_multipart', 'check_http_response',
+        'http_get', 'http_post', 'http_put', 'http_delete', 'http_patch',
+        'http_session_get', 'http_session_post', 'http_session_put', 'http_session_delete', 'http_session_patch',
+        'httpx_get', 'httpx_post', 'httpx_put', 'httpx_delete', 'httpx_patch',
+        'httpx_session_get', 'httpx_session_post', 'httpx_session_put', 'httpx_session_delete', 'httpx_session_patch',
+        'encode_session_base64', 'decode_session_base64', 'sockinfo', 'run_proxy', 'sendall', 'recvall',
+        'acceptall', 'eventfd', 'sock_connect', 'is_readable', 'is_port_in_use', 'run_proxy_async',
+    ),
+    '.dateutils': (
+        'YmdHMS', 'datetimestr', 'pretty_duration', 'utc_to_local', 'timestamp_seconds',
+        'timestamp_millis', 'local_timestamp', 'datestr2ts',
+    ),
+    '.datautils': (
+        'create_figure', 'save_figure', 'draw_single_line', 'draw_multi_lines', 'draw_single_bar',
+        'draw_grouped_bar', 'draw_multi_kde',
+    ),
+    '.dbgutils': (
+        'assert_that', 'simple_timing', 'debug_timing', 'time_measurer',
+    ),
+    '.dsutils': (
+        'pget', 'flatten', 'kvdict', 'kdict', 'set_with_key',
+    ),
+    '.urlutils': (
+        'get_param',
+    ),
+    '.cryptutils': (
+        'aes_encrypt', 'aes_decrypt',
+    ),
+    '.objutils': (
+        'parent', 'singleton',
+    ),
+    '.asyncutils': (
+        'wait_for_complete',
+    ),
+    '.sqliteutils': (
+        'sqlite3_connect', 'sqlite3_close_all', 'sqlite3_set_max_idle', 'sqlite3_set_profile',
+        'sqlite3_cursor',
+        'sqlite3_execute', 'sqlite3_query', 'sqlite3_iter_query', 'sqlite3_iter_table', 'sqlite3_tables', 'sqlite3_select_all', 'sqlite3_dump', 'sqlite3_get', 'sqlite3_delete', 'sqlite3_put',
+        'sqlite3_jget', 'sqlite3_jget_all', 'sqlite3_jput',
+        'sqlite3_get_many', 'sqlite3_put_many', 'sqlite3_jget_many', 'sqlite3_jput_many', 'sqlite3_delete_many',
+        'sqlite3_scan',
+        'sqlite3_set_cache_policy', 'sqlite3_purge', 'sqlite3_set_memory_cache', 'sqlite3_memory_cache_info',
+        'sqlite3_set_negative_cache', 'sqlite3_negative_cache_info',
+        'sqlite3_set_compression', 'sqlite3_register_codec', 'sqlite3_set_serializer', 'sqlite3_register_serializer',
+        'sqlite3_set_write_behind', 'sqlite3_flush',
+        'sqlite3_jquery', 'sqlite3_jindex', 'sqlite3_fts_index', 'sqlite3_search', 'ShardedKV', 'SqliteQueue', 'QueueItem',
+        'asqlite3_execute', 'asqlite3_query', 'asqlite3_get', 'asqlite3_put', 'asqlite3_delete',
+        'asqlite3_jget', 'asqlite3_jput', 'asqlite3_get_many', 'asqlite3_put_many', 'asqlite3_jget_many',
+        'asqlite3_jput_many', 'asqlite3_delete_many', 'asqlite3_jquery', 'asqlite3_search',
+        'sqlalchemy_get_engine', 'sqlalchemy_dispose_all', 'sqlalchemy_get_session', 'sqlalchemy_execute',
+        'sqlalchemy_iter_execute',
+    ),
+}
+
+_SUBMODULES = tuple(m[1:] for m in _EXPORTS if m.startswith('.'))
+
+_NAME_TO_MODULE = {}
+for _module, _names in _EXPORTS.items():
+    for _name in _names:
+        _NAME_TO_MODULE.setdefault(_name, _module)
+
+__all__ = ['CLICK_CONTEXT_SETTINGS', *_NAME_TO_MODULE]
+
+del _module, _names, _name
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    module_name = _NAME_TO_MODULE.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value     # cache it, __getattr__ is only called on misses
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
+
+
+# QQUTILS_EAGER_IMPORT=1 restores the old behaviour of importing everything up front
+if os.getenv('QQUTILS_EAGER_IMPORT', '').lower() in ('1', 'true', 'yes'):
+    for _name in __all__:
+        if _name not in globals():
+            __getattr__(_name)
@@ -0,0 +1,171 @@
+"""Benchmarks for qqutils.
+
+Usage:
+
+    python -m qqutils.bench startup
+    python -m qqutils.bench startup -m qqutils.dsutils -b qqutils.dsutils=20 --default-budget 500
+"""
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+from typing import Dict, List, Iterable
+import click
+from . import CLICK_CONTEXT_SETTINGS, _SUBMODULES
+
+# Run inside the fresh interpreter: time the import itself, then report
+# peak RSS and the set of loaded modules back to the parent as JSON.
+# The marker separates -X importtime lines of site and the probe from the target's.
+_MARKER = '-- qqutils.bench import --'
+_PROBE = r'''
+import sys, time, json, resource
+sys.stderr.write({marker!r} + '\n')
+sys.stderr.flush()
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss = rss if sys.platform == 'darwin' else rss * 1024
+print(json.dumps({{'import_ms': elapsed * 1000, 'rss': rss, 'modules': sorted(sys.modules)}}))
+'''
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def _default_modules() -> List[str]:
+    return ['qqutils'] + [f'qqutils.{m}' for m in _SUBMODULES]
+
+
+def _parse_importtime(stderr: str) -> List[dict]:
+    """Parse ``-X importtime`` output into ``{module, self_us, cumulative_us, depth}`` records."""
+    records = []
+    for line in stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, module = m.groups()
+        records.append({
+            'module': module,
+            'self_us': int(self_us),
+            'cumulative_us': int(cumulative_us),
+            'depth': (len(indent) - 1) // 2,
+        })
+    return records
+
+
+def _heavy_imports(records: Iterable[dict], threshold_ms: float) -> List[dict]:
+    """Third-party top-level packages whose cumulative import time exceeds ``threshold_ms``."""
+    stdlib = getattr(sys, 'stdlib_module_names', ())
+    heavy: Dict[str, int] = {}
+    for r in records:
+        top = r['module'].split('.')[0]
+        if r['module'] != top or top in stdlib or top in ('qqutils', '_distutils_hack'):
+            continue
+        heavy[top] = max(heavy.get(top, 0), r['cumulative_us'])
+    return [
+        {'module': m, 'cumulative_ms': us / 1000}
+        for m, us in sorted(heavy.items(), key=lambda kv: kv[1], reverse=True)
+        if us / 1000 >= threshold_ms
+    ]
+
+
+def measure_import(module: str, repeat: int = 3, heavy_threshold_ms: float = 5.0) -> dict:
+    """Import ``module`` in ``repeat`` fresh interpreters and keep the fastest run."""
+    best = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module, marker=_MARKER)],
+            capture_output=True, text=True, env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+        )
+        wall_ms = (time.perf_counter() - start) * 1000
+        if proc.returncode != 0:
+            raise RuntimeError(f'Failed to import {module}: {proc.stderr.strip().splitlines()[-1:]}')
+        probe = json.loads(proc.stdout.strip().splitlines()[-1])
+        run = {
+            'module': module,
+            'wall_ms': wall_ms,
+            'import_ms': probe['import_ms'],
+            'rss': probe['rss'],
+            'modules': len(probe['modules']),
+            'importtime': _parse_importtime(proc.stderr.partition(_MARKER)[2]),
+        }
+        if best is None or run['import_ms'] < best['import_ms']:
+            best = run
+    best['heavy'] = _heavy_imports(best['importtime'], heavy_threshold_ms)
+    return best
+
+
+def check_budgets(results: List[dict], budgets: Dict[str, float], default_budget: float = None) -> List[str]:
+    """Return a message for each result whose ``import_ms`` is over its budget."""
+    violations = []
+    for r in results:
+        budget = budgets.get(r['module'], default_budget)
+        if budget is not None and r['import_ms'] > budget:
+            violations.append(f"{r['module']}: {r['import_ms']:.1f}ms > budget {budget:.1f}ms")
+    return violations
+
+
+def _parse_budgets(values: Iterable[str]) -> Dict[str, float]:
+    budgets = {}
+    for v in values:
+        module, sep, ms = v.partition('=')
+        if not sep:
+            raise click.BadParameter(f'expected MODULE=MS, got {v!r}', param_hint='--budget')
+        budgets[module.strip()] = float(ms)
+    return budgets
+
+
+@click.group(context_settings=CLICK_CONTEXT_SETTINGS)
+def cli():
+    pass
+
+
+@cli.command(context_settings=CLICK_CONTEXT_SETTINGS)
+@click.option('--module', '-m', 'modules', multiple=True, help='Module to measure (default: qqutils and every submodule)')
+@click.option('--repeat', '-n', default=3, show_default=True, help='Fresh interpreters per module, fastest run is kept')
+@click.option('--budget', '-b', 'budgets', multiple=True, help='Per-module budget as MODULE=MS (also QQUTILS_BENCH_BUDGETS, comma separated)')
+@click.option('--default-budget', type=float, default=None, help='Budget in ms for modules without an explicit one')
+@click.option('--heavy-threshold', type=float, default=5.0, show_default=True, help='Report third-party imports slower than this (ms)')
+@click.option('--top', default=10, show_default=True, help='Number of slowest -X importtime entries to show per module')
+@click.option('--json', 'as_json', is_flag=True, help='Print raw results as JSON')
+def startup(modules, repeat, budgets, default_budget, heavy_threshold, top, as_json):
+    """Measure cold import time, RSS and heavy transitive imports."""
+    env_budgets = [b for b in os.getenv('QQUTILS_BENCH_BUDGETS', '').split(',') if b.strip()]
+    budget_map = _parse_budgets(env_budgets + list(budgets))
+    results = [measure_import(m, repeat, heavy_threshold) for m in (modules or _default_modules())]
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        from hprint import hprint
+        from .stringutils import format_bytes
+        hprint([
+            {
+                'module': r['module'],
+                'import (ms)': round(r['import_ms'], 1),
+                'wall (ms)': round(r['wall_ms'], 1),
+                'rss': '%s%s' % format_bytes(r['rss']),
+                'modules': r['modules'],
+                'budget (ms)': budget_map.get(r['module'], default_budget),
+                'heavy': ', '.join(h['module'] for h in r['heavy']),
+            }
+            for r in results
+        ])
+        for r in results:
+            slowest = sorted(r['importtime'], key=lambda x: x['self_us'], reverse=True)[:top]
+            click.echo(f"\n{r['module']}: slowest imports (self time)")
+            for x in slowest:
+                click.echo(f"  {x['self_us'] / 1000:8.1f}ms  {x['cumulative_us'] / 1000:8.1f}ms  {x['module']}")
+
+    violations = check_budgets(results, budget_map, default_budget)
+    for v in violations:
+        click.echo(f'Budget exceeded: {v}', err=True)
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -4,27 +4,82 @@ import array
 import hashlib
 import itertools
 import math
+import mmap as _mmap
+import operator
+import os
 import random
 import string
+import struct
 import time
 from collections.abc import Callable, Iterable, MutableSequence
 from dataclasses import dataclass
 
+try:
+    import numpy as np
+except ImportError:     # PyBitArray is used instead
+    np = None
+
+
+def _blake2b_128(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# 128-bit digests available to DoubleHashing
+DIGESTS = {'blake2b': _blake2b_128}
+try:
+    import xxhash
+    DIGESTS['xxh3'] = xxhash.xxh3_128_digest
+except ImportError:
+    pass
+
+_MASK64 = (1 << 64) - 1
+
+# save()/load() file layout: this header, then the raw bit buffer
+_MAGIC = b'QQBITS01'
+_HEADER = struct.Struct('<8sQIQ32s4x')   # magic, m (bits), k (0 for a bare BitArray), item count, hash strategy
+
+
+def _save(path: str, bits, n_hashes: int = 0, n_items: int = 0, strategy: str = ''):
+    # write aside and rename, so processes that mapped the old file keep a consistent view
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(bits), n_hashes, n_items, strategy.encode()))
+        f.write(bits.data)
+    os.replace(tmp, path)
+
+
+def _read_header(f, path: str) -> tuple:
+    raw = f.read(_HEADER.size)
+    if len(raw) < _HEADER.size or not raw.startswith(_MAGIC):
+        raise ValueError(f"{path} was not written by save()")
+    _, m, n_hashes, n_items, strategy = _HEADER.unpack(raw)
+    return m, n_hashes, n_items, strategy.rstrip(b'\0').decode()
+
+
+def _batched(iterable, n):
+    # itertools.batched is only available since Python 3.12
+    it = iter(iterable)
+    while True:
+        batch = tuple(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
 
 def _8_bools_to_int(bools) -> int:
-    bin_str = ''.join('1' if b else '0' for b in reversed(bools))
-    return int(bin_str, 2)
+    return sum(1 << i for i, b in enumerate(bools) if b)
 
 
 @dataclass
-class BitArray:
+class PyBitArray:
+    """Pure-Python bit array, bit n is bit n % 8 of byte n // 8"""
     data: array.array
     size: int
 
     @classmethod
     def _to_bytes(cls, iterable, iter_len_out: list):
         iterable = (bool(x) for x in iterable)
-        iterable = itertools.batched(iterable, 8)
+        iterable = _batched(iterable, 8)
         iter_len = 0
         for x in iterable:
             iter_len += len(x)
@@ -45,7 +100,7 @@ class BitArray:
         arr_size, remainder = divmod(n, 8)
         if remainder:
             arr_size += 1
-        data = array.array('B', (0 for _ in range(arr_size)))
+        data = array.array('B', bytes(arr_size))
         return cls(data=data, size=n)
 
     def _check_index(self, n):
@@ -67,6 +122,170 @@ class BitArray:
         data |= (bool(bit) * (1 << bit_idx))  # set bit
         self.data[arr_idx] = data
 
+    def set_many(self, indices: Iterable[int]):
+        for n in map(operator.index, indices):
+            self._check_index(n)
+            self.data[n >> 3] |= 1 << (n & 7)
+
+    def test_many(self, indices: Iterable[int]) -> list:
+        indices = list(map(operator.index, indices))
+        for n in indices:
+            self._check_index(n)
+        data = self.data
+        return [bool((data[n >> 3] >> (n & 7)) & 1) for n in indices]
+
+    def count(self) -> int:
+        return sum(bin(b).count('1') for b in self.data)
+
+    def __iter__(self):
+        bits = ((b >> i) & 1 for b in self.data for i in range(8))
+        return itertools.islice(bits, self.size)
+
+    def _combine(self, other, op):
+        if not isinstance(other, PyBitArray):
+            return NotImplemented
+        if other.size != self.size:
+            raise ValueError(f"size mismatch: {self.size} != {other.size}")
+        return type(self)(data=array.array('B', map(op, self.data, other.data)), size=self.size)
+
+    def __or__(self, other):
+        return self._combine(other, operator.or_)
+
+    def __and__(self, other):
+        return self._combine(other, operator.and_)
+
+    def __xor__(self, other):
+        return self._combine(other, operator.xor)
+
+    def save(self, path: str):
+        _save(path, self)
+
+    @classmethod
+    def _load(cls, path: str, mmap: bool, mode: str) -> tuple:
+        with open(path, 'r+b' if mmap and mode == 'r+' else 'rb') as f:     # ACCESS_WRITE needs a writable descriptor
+            m, n_hashes, n_items, strategy = _read_header(f, path)
+            n_bytes = (m + 7) // 8
+            if mmap:
+                access = {'r': _mmap.ACCESS_READ, 'r+': _mmap.ACCESS_WRITE, 'c': _mmap.ACCESS_COPY}[mode]
+                data = memoryview(_mmap.mmap(f.fileno(), 0, access=access))[_HEADER.size:_HEADER.size + n_bytes]
+            else:
+                data = array.array('B', f.read(n_bytes))
+        return cls(data=data, size=m), n_hashes, n_items, strategy
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, mode: str = 'r'):
+        """Bit array written by save(), mapped with mode 'r' (read-only), 'r+' (writes go to the file)
+        or 'c' (copy-on-write) so that processes share the same page cache pages"""
+        return cls._load(path, mmap, mode)[0]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self)})"
+
+    def __len__(self):
+        return self.size
+
+
+@dataclass(eq=False)
+class NumpyBitArray:
+    """Bit array on a NumPy uint8 buffer with vectorized bulk operations, same bit layout as PyBitArray"""
+    data: 'np.ndarray'
+    size: int
+
+    _ITER_CHUNK = 1 << 16   # bytes unpacked at a time by __iter__
+
+    @classmethod
+    def from_iterable(cls, iterable: Iterable):
+        bits = np.fromiter((bool(x) for x in iterable), dtype=bool)
+        return cls(data=np.packbits(bits, bitorder='little'), size=len(bits))
+
+    @classmethod
+    def zeros(cls, n: int):
+        return cls(data=np.zeros((n + 7) // 8, dtype=np.uint8), size=n)
+
+    def _check_index(self, n):
+        n = operator.index(n)
+        if not 0 <= n < self.size:
+            raise IndexError(n)
+        return n
+
+    def _check_indices(self, indices) -> 'np.ndarray':
+        indices = np.asarray(indices if isinstance(indices, np.ndarray) else list(indices))
+        if indices.size and not np.issubdtype(indices.dtype, np.integer):
+            raise TypeError("expected int")
+        indices = indices.astype(np.int64, copy=False)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.size):
+            raise IndexError("index out of range")
+        return indices
+
+    def __getitem__(self, n):
+        n = self._check_index(n)
+        return (int(self.data[n >> 3]) >> (n & 7)) & 0b1
+
+    def __setitem__(self, n, bit):
+        n = self._check_index(n)
+        if bit:
+            self.data[n >> 3] |= np.uint8(1 << (n & 7))
+        else:
+            self.data[n >> 3] &= np.uint8(~(1 << (n & 7)) & 0xFF)
+
+    def set_many(self, indices: Iterable[int]):
+        indices = self._check_indices(indices)
+        np.bitwise_or.at(self.data, indices >> 3, np.left_shift(1, indices & 7).astype(np.uint8))
+
+    def test_many(self, indices: Iterable[int]) -> 'np.ndarray':
+        indices = self._check_indices(indices)
+        return ((self.data[indices >> 3] >> (indices & 7).astype(np.uint8)) & 1).astype(bool)
+
+    def count(self) -> int:
+        if hasattr(np, 'bitwise_count'):     # NumPy >= 2.0
+            return int(np.bitwise_count(self.data).sum(dtype=np.int64))
+        return int(np.unpackbits(self.data).sum(dtype=np.int64))
+
+    def __iter__(self):
+        for start in range(0, len(self.data), self._ITER_CHUNK):
+            chunk = np.unpackbits(self.data[start:start + self._ITER_CHUNK], bitorder='little')
+            yield from chunk[:self.size - start * 8].tolist()
+
+    def _combine(self, other, op):
+        if not isinstance(other, NumpyBitArray):
+            return NotImplemented
+        if other.size != self.size:
+            raise ValueError(f"size mismatch: {self.size} != {other.size}")
+        return type(self)(data=op(self.data, other.data), size=self.size)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and)
+
+    def __xor__(self, other):
+        return self._combine(other, np.bitwise_xor)
+
+    def __eq__(self, other):
+        if not isinstance(other, NumpyBitArray):
+            return NotImplemented
+        return self.size == other.size and np.array_equal(self.data, other.data)
+
+    def save(self, path: str):
+        _save(path, self)
+
+    @classmethod
+    def _load(cls, path: str, mmap: bool, mode: str) -> tuple:
+        with open(path, 'rb') as f:
+            m, n_hashes, n_items, strategy = _read_header(f, path)
+        n_bytes = (m + 7) // 8
+        if mmap:
+            data = np.memmap(path, dtype=np.uint8, mode=mode, offset=_HEADER.size, shape=(n_bytes,))
+        else:
+            data = np.fromfile(path, dtype=np.uint8, count=n_bytes, offset=_HEADER.size)
+        return cls(data=data, size=m), n_hashes, n_items, strategy
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, mode: str = 'r'):
+        """Bit array written by save(), see PyBitArray.load"""
+        return cls._load(path, mmap, mode)[0]
+
     def __repr__(self):
         return f"{self.__class__.__name__}({list(self)})"
 
@@ -74,21 +293,244 @@ class BitArray:
         return self.size
 
 
+BitArray = NumpyBitArray if np is not None else PyBitArray
+
+
 @dataclass
 class BloomFilter:
     mem: MutableSequence[int]
     calc_hashes: Callable
+    n_items: int = 0    # items added, duplicates included
+
+    _CHUNK_SIZE = 1 << 16   # items hashed per vectorized pass of add_many/contains_many
 
     @staticmethod
     def estimate_false_positive_rate(n_hashes: int, mem_size: int, n_items: int):
         return (1.0 - math.exp(- n_hashes * n_items / mem_size)) ** n_hashes
 
+    @staticmethod
+    def optimal_size(n_items: int, fp_rate: float) -> tuple:
+        """(mem_size, n_hashes) minimizing memory for n_items at fp_rate"""
+        if not 0 < fp_rate < 1:
+            raise ValueError(f"fp_rate should be in (0, 1), got {fp_rate}")
+        n_items = max(n_items, 1)
+        mem_size = math.ceil(-n_items * math.log(fp_rate) / math.log(2) ** 2)
+        n_hashes = max(round(mem_size / n_items * math.log(2)), 1)
+        return mem_size, n_hashes
+
+    @classmethod
+    def for_capacity(cls, n_items: int, fp_rate: float = 0.01, digest: str = 'blake2b'):
+        """Empty filter on a BitArray sized for n_items at fp_rate, with DoubleHashing"""
+        mem_size, n_hashes = cls.optimal_size(n_items, fp_rate)
+        return cls(mem=BitArray.zeros(mem_size), calc_hashes=DoubleHashing(n_hashes, digest))
+
+    @property
+    def n_hashes(self) -> int:
+        hashes = getattr(self.calc_hashes, 'hashes', None)
+        return hashes if hashes is not None else len(self.calc_hashes(b''))
+
+    @property
+    def fill_ratio(self) -> float:
+        """Fraction of bits set"""
+        count = getattr(self.mem, 'count', None)
+        ones = count() if callable(count) else sum(1 for b in self.mem if b)
+        return ones / len(self.mem)
+
+    @property
+    def estimated_count(self) -> float:
+        """Number of distinct items added, estimated from fill_ratio (Swamidass & Baldi)"""
+        fill = self.fill_ratio
+        if fill >= 1:
+            return math.inf
+        return -len(self.mem) / self.n_hashes * math.log(1 - fill)
+
     def add(self, item):
+        m = len(self.mem)
         for h in self.calc_hashes(item):
-            self.mem[h % len(self.mem)] = 1
+            self.mem[h % m] = 1
+        self.n_items += 1
 
     def __contains__(self, item):
-        return all(self.mem[h % len(self.mem)] for h in self.calc_hashes(item))
+        m = len(self.mem)
+        return all(self.mem[h % m] for h in self.calc_hashes(item))
+
+    def _positions(self, items: tuple):
+        """Bit positions of a chunk of items: an (items, k) int64 array, or a list of rows without NumPy"""
+        m = len(self.mem)
+        many = getattr(self.calc_hashes, 'many', None)
+        if many is not None and np is not None:
+            return (many(items) % np.uint64(m)).astype(np.int64)
+        rows = [[h % m for h in self.calc_hashes(item)] for item in items]
+        return np.array(rows, dtype=np.int64) if np is not None else rows
+
+    def add_many(self, items: Iterable):
+        set_many = getattr(self.mem, 'set_many', None)
+        for chunk in _batched(items, self._CHUNK_SIZE):
+            positions = self._positions(chunk)
+            positions = positions.ravel() if np is not None else [p for row in positions for p in row]
+            if set_many is not None:
+                set_many(positions)
+            else:
+                for p in positions:
+                    self.mem[int(p)] = 1
+            self.n_items += len(chunk)
+
+    def contains_many(self, items: Iterable):
+        """Membership of each item, as a boolean array (a list of bools without NumPy)"""
+        test_many = getattr(self.mem, 'test_many', None)
+        results = []
+        for chunk in _batched(items, self._CHUNK_SIZE):
+            positions = self._positions(chunk)
+            if np is None:
+                results.extend(all(bool(self.mem[p]) for p in row) for row in positions)
+                continue
+            flat = positions.ravel()
+            bits = test_many(flat) if test_many is not None else [bool(self.mem[int(p)]) for p in flat]
+            results.append(np.asarray(bits, dtype=bool).reshape(positions.shape).all(axis=1))
+        if np is None:
+            return results
+        return np.concatenate(results) if results else np.zeros(0, dtype=bool)
+
+    def save(self, path: str):
+        """Write m, k, the hash strategy, n_items and the bits to path (DoubleHashing filters on a BitArray)"""
+        if not isinstance(self.calc_hashes, DoubleHashing):
+            raise ValueError("only filters using DoubleHashing can be saved")
+        _save(path, self.mem, self.calc_hashes.hashes, self.n_items, self.calc_hashes.name)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, mode: str = 'r'):
+        """Filter written by save(). With mmap its bits are mapped, not read (see PyBitArray.load);
+        the default read-only mode is enough for lookups"""
+        mem, n_hashes, n_items, strategy = BitArray._load(path, mmap, mode)
+        return cls(mem=mem, calc_hashes=DoubleHashing.from_name(strategy, n_hashes), n_items=n_items)
+
+
+@dataclass
+class ScalableBloomFilter:
+    """Bloom filter for streams of unknown size (Almeida et al.).
+
+    Starts with one slice sized for `initial_capacity` items and adds a slice
+    `growth` times larger whenever the last one is full. Slice i targets
+    fp_rate * (1 - tightening) * tightening ** i, so the overall false positive
+    rate stays below fp_rate however many slices are added.
+    """
+    initial_capacity: int = 1024
+    fp_rate: float = 0.01
+    growth: int = 2
+    tightening: float = 0.5
+    digest: str = 'blake2b'
+
+    def __post_init__(self):
+        self.slices = []
+        self._capacities = []
+        self._counts = []
+        self._add_slice()
+
+    def _add_slice(self):
+        i = len(self.slices)
+        capacity = self.initial_capacity * self.growth ** i
+        fp_rate = self.fp_rate * (1 - self.tightening) * self.tightening ** i
+        self.slices.append(BloomFilter.for_capacity(capacity, fp_rate, self.digest))
+        self._capacities.append(capacity)
+        self._counts.append(0)
+
+    @property
+    def count(self) -> int:
+        """Items added that were not already (seemingly) present"""
+        return sum(self._counts)
+
+    @property
+    def estimated_count(self) -> float:
+        return sum(s.estimated_count for s in self.slices)
+
+    @property
+    def fill_ratio(self) -> float:
+        """Fraction of bits set over all slices"""
+        return sum(s.fill_ratio * len(s.mem) for s in self.slices) / sum(len(s.mem) for s in self.slices)
+
+    def add(self, item):
+        if item not in self:
+            self._append([item])
+
+    def add_many(self, items: Iterable):
+        for chunk in _batched(items, BloomFilter._CHUNK_SIZE):
+            seen = set()
+            new = [x for x, hit in zip(chunk, self.contains_many(chunk)) if not hit and not (x in seen or seen.add(x))]
+            self._append(new)
+
+    def _append(self, items: list):
+        while items:
+            room = self._capacities[-1] - self._counts[-1]
+            if room <= 0:
+                self._add_slice()
+                continue
+            part, items = items[:room], items[room:]
+            self.slices[-1].add_many(part)
+            self._counts[-1] += len(part)
+
+    def __contains__(self, item):
+        return any(item in s for s in reversed(self.slices))
+
+    def contains_many(self, items: Iterable):
+        """Membership of each item, as a boolean array (a list of bools without NumPy)"""
+        items = list(items)
+        hits = None
+        for s in self.slices:
+            found = s.contains_many(items)
+            if np is not None:
+                hits = found if hits is None else hits | found
+            else:
+                hits = found if hits is None else [a or b for a, b in zip(hits, found)]
+        return hits
+
+    def __len__(self):
+        return self.count
+
+
+def _item_bytes(item) -> bytes:
+    return item if isinstance(item, (bytes, bytearray, memoryview)) else str(item).encode()
+
+
+@dataclass
+class DoubleHashing:
+    """Kirsch-Mitzenmacher double hashing, usable as calc_hashes.
+
+    One 128-bit digest per item is split into h1 and h2, and the k hashes are
+    h1 + i * h2 (mod 2**64), which keeps the false positive rate of k
+    independent hashes. many() computes them for a batch of items at once.
+    """
+    hashes: int
+    digest: str = 'blake2b'
+
+    def __post_init__(self):
+        if self.digest not in DIGESTS:
+            raise ValueError(f"unknown digest {self.digest!r}, expected one of {', '.join(DIGESTS)}")
+        self._digest = DIGESTS[self.digest]
+
+    @property
+    def name(self) -> str:
+        return f'double-{self.digest}'
+
+    @classmethod
+    def from_name(cls, name: str, hashes: int):
+        kind, _, digest = name.partition('-')
+        if kind != 'double':
+            raise ValueError(f"unknown hash strategy {name!r}")
+        return cls(hashes, digest)
+
+    def __call__(self, item) -> list:
+        d = self._digest(_item_bytes(item))
+        h1 = int.from_bytes(d[:8], byteorder='little')
+        h2 = int.from_bytes(d[8:16], byteorder='little') | 1
+        return [(h1 + i * h2) & _MASK64 for i in range(self.hashes)]
+
+    def many(self, items: Iterable) -> 'np.ndarray':
+        """(items, k) uint64 array, row i equals self(items[i])"""
+        digest = self._digest
+        buf = b''.join([digest(_item_bytes(item)) for item in items])
+        digests = np.frombuffer(buf, dtype='<u8').reshape(-1, 2)
+        h1, h2 = digests[:, :1], digests[:, 1:] | np.uint64(1)
+        return h1 + np.arange(self.hashes, dtype=np.uint64) * h2     # wraps around like __call__
 
 
 def split_long_hash(
@@ -142,19 +584,8 @@ class Timer:
 
 
 def bloom_example():
-    def long_hash(s: str) -> int:
-        h = hashlib.sha256()
-        h.update(s.encode())
-        return int.from_bytes(h.digest(), byteorder='big')
-
     n_hashes = 5
-    bytes_per_hash = 6
-
-    calc_hashes = split_long_hash(
-        long_hash,
-        digest_size=256 // 8,
-        hashes=n_hashes,
-        bytes_per_hash=bytes_per_hash)
+    calc_hashes = DoubleHashing(n_hashes)
 
     mem_size = 80_000_000
     elem_count = 10_000_000
@@ -167,14 +598,13 @@ def bloom_example():
         strs = {random_str(16) for _ in range(elem_count)}
 
     with Timer("Adding strs"):
-        for s in strs:
-            bloom.add(s)
+        bloom.add_many(strs)
 
     with Timer("checking no false negatives"):
-        assert all(s in bloom for s in strs)
+        assert bloom.contains_many(strs).all()
 
     with Timer("checking false positives"):
-        false_positives = sum((random_str(15) in bloom) for _ in range(elem_count))
+        false_positives = int(bloom.contains_many(random_str(15) for _ in range(elem_count)).sum())
 
     fpr_estimated = bloom.estimate_false_positive_rate(n_hashes, mem_size, elem_count)
     print(f"False positive estimate: {fpr_estimated * 100:.03f}%")
@@ -1,21 +1,44 @@
 import os
+import re
+import atexit
 import json
+import asyncio
+import time
 import sqlite3
 import logging
 import tempfile
+import zlib
+import hashlib
+import pickle
+import marshal
+import heapq
+import itertools
+import threading
+import queue
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import List
 from hprint import hprint
-from contextlib import closing
-from typing import Iterable, Any, Optional, Dict
-from sqlalchemy import create_engine, Engine, text
-from sqlalchemy.orm import sessionmaker, Session
+from contextlib import closing, contextmanager
+from typing import Iterable, Iterator, Any, Callable, Optional, Dict, Tuple, Union, Mapping, TYPE_CHECKING
 import getpass
+from .threadutils import create_thread_pool, submit_daemon_thread
+
+if TYPE_CHECKING:
+    from sqlalchemy import Engine, Row
+    from sqlalchemy.orm import Session, sessionmaker
 
 __all__ = (
     'sqlite3_connect',
+    'sqlite3_close_all',
+    'sqlite3_set_max_idle',
+    'sqlite3_set_profile',
     'sqlite3_cursor',
     'sqlite3_execute',
     'sqlite3_query',
+    'sqlite3_iter_query',
+    'sqlite3_iter_table',
     'sqlite3_tables',
     'sqlite3_select_all',
     'sqlite3_dump',
@@ -25,23 +48,953 @@ __all__ = (
     'sqlite3_jget',
     'sqlite3_jget_all',
     'sqlite3_jput',
+    'sqlite3_get_many',
+    'sqlite3_put_many',
+    'sqlite3_jget_many',
+    'sqlite3_jput_many',
+    'sqlite3_delete_many',
+    'sqlite3_scan',
+    'sqlite3_set_cache_policy',
+    'sqlite3_purge',
+    'sqlite3_set_memory_cache',
+    'sqlite3_memory_cache_info',
+    'sqlite3_set_negative_cache',
+    'sqlite3_negative_cache_info',
+    'sqlite3_set_compression',
+    'sqlite3_register_codec',
+    'sqlite3_set_serializer',
+    'sqlite3_register_serializer',
+    'sqlite3_set_write_behind',
+    'sqlite3_flush',
+    'sqlite3_jquery',
+    'sqlite3_jindex',
+    'sqlite3_fts_index',
+    'sqlite3_search',
+    'ShardedKV',
+    'SqliteQueue',
+    'QueueItem',
+    'asqlite3_execute',
+    'asqlite3_query',
+    'asqlite3_get',
+    'asqlite3_put',
+    'asqlite3_delete',
+    'asqlite3_jget',
+    'asqlite3_jput',
+    'asqlite3_get_many',
+    'asqlite3_put_many',
+    'asqlite3_jget_many',
+    'asqlite3_jput_many',
+    'asqlite3_delete_many',
+    'asqlite3_jquery',
+    'asqlite3_search',
     'sqlalchemy_get_engine',
+    'sqlalchemy_dispose_all',
     'sqlalchemy_get_session',
     'sqlalchemy_execute',
+    'sqlalchemy_iter_execute',
 )
 
 logger = logging.getLogger(__name__)
 
 _DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), f'__qqutils_{os.getenv("SUDO_USER") or getpass.getuser()}__.db')
 
+# PRAGMAs applied to every connection opened by sqlite3_connect and the sqlite3_* helpers,
+# busy_timeout goes first so that switching journal_mode waits for other connections
+_PROFILES = {
+    'durable': {
+        'busy_timeout': 10_000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16_000,          # KiB
+        'temp_store': 'MEMORY',
+    },
+    'fast': {
+        'busy_timeout': 10_000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64_000,
+        'temp_store': 'MEMORY',
+    },
+    'readonly': {
+        'busy_timeout': 10_000,
+        'query_only': 'ON',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64_000,
+        'temp_store': 'MEMORY',
+    },
+}
+
+_DB_PROFILES: Dict[Optional[str], Union[str, dict, None]] = {}    # db_path (None for all) -> profile
+
+
+def _profile_pragmas(profile: Union[str, dict, None]) -> dict:
+    if not profile or profile == 'default':
+        return {}
+    if isinstance(profile, dict):
+        return profile
+    try:
+        return _PROFILES[profile]
+    except KeyError:
+        raise ValueError(f'Unknown SQLite profile {profile!r}, expected one of {", ".join(_PROFILES)}') from None
+
+
+def _resolve_pragmas(db_path: str) -> dict:
+    """Profile for db_path: per-db setting, then process-wide setting, then QQUTILS_SQLITE_PROFILE"""
+    if db_path in _DB_PROFILES:
+        return _profile_pragmas(_DB_PROFILES[db_path])
+    if None in _DB_PROFILES:
+        return _profile_pragmas(_DB_PROFILES[None])
+    return _profile_pragmas(os.getenv('QQUTILS_SQLITE_PROFILE'))
+
+
+def _open(db_path: str, pragmas: dict = None, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, **kwargs)
+    for name, value in (_resolve_pragmas(db_path) if pragmas is None else pragmas).items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+class _ConnectionPool:
+    """Keep one open connection per (thread, db_path).
+
+    Connections are opened with ``check_same_thread=False`` only so that
+    ``close_all`` can close them from any thread; each one is still used by
+    the thread that opened it.
+    """
+
+    def __init__(self, max_idle: float = None):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._conns = {}        # (thread ident, db_path) -> [conn, last used, pragmas]
+
+    def _reset_after_fork(self):
+        # connections inherited from the parent process must not be used (or closed) here
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conns = {}
+
+    def _evict_idle(self, now: float):
+        # only connections of the calling thread or of finished threads, others may be in use
+        alive = {t.ident for t in threading.enumerate()} - {threading.get_ident()}
+        expired = [k for k, (_, used, _) in self._conns.items() if now - used > self.max_idle and k[0] not in alive]
+        for k in expired:
+            conn = self._conns.pop(k)[0]
+            logger.debug(f'[{k[1]}] Closing connection idle for more than {self.max_idle}s')
+            conn.close()
+
+    def acquire(self, db_path: str) -> sqlite3.Connection:
+        key = (threading.get_ident(), db_path)
+        now = time.monotonic()
+        pragmas = _resolve_pragmas(db_path)
+        stale = None
+        with self._lock:
+            self._reset_after_fork()
+            if self.max_idle is not None:
+                self._evict_idle(now)
+            entry = self._conns.get(key)
+            if entry is not None:
+                if entry[2] == pragmas:
+                    entry[1] = now
+                    return entry[0]
+                stale = self._conns.pop(key)[0]     # profile changed since it was opened
+        if stale is not None:
+            stale.close()
+        conn = _open(db_path, pragmas, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conns[key] = [conn, now, pragmas]
+        return conn
+
+    def close_all(self, db_path: str = None) -> int:
+        with self._lock:
+            self._reset_after_fork()
+            keys = [k for k in self._conns if db_path is None or k[1] == db_path]
+            conns = [self._conns.pop(k)[0] for k in keys]
+        for conn in conns:
+            conn.close()
+        return len(conns)
+
+
+_POOL = _ConnectionPool(max_idle=float(os.getenv('QQUTILS_SQLITE_MAX_IDLE', 0)) or None)
+
+
+@contextmanager
+def _connection(db_path: str = None):
+    """Borrow the pooled connection of the current thread, rolling back on error"""
+    conn = _POOL.acquire(db_path or _DEFAULT_DB_PATH)
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+
+_CACHE_TABLE_READY = set()     # db_paths whose __cache__ table is known to exist in this process
+_CACHE_TABLE_LOCK = threading.Lock()
+
+# columns added after the original (key, value, data) schema, migrated in place
+_CACHE_COLUMNS = {
+    'expires_at': 'REAL',       # unix time after which the row is ignored, NULL = never
+    'atime': 'REAL',            # last access time, drives LRU eviction
+    'payload': 'BLOB',          # encoded (e.g. compressed) data, data is NULL then
+    'codec': 'TEXT',            # codec of payload
+    'serializer': 'TEXT',       # serializer of payload, NULL = JSON
+}
+# logical payloads and the physical columns holding them, raw (encoded) values are tuples in this order
+_CACHE_FIELDS = {
+    'value': ('value',),
+    'data': ('data', 'payload', 'codec', 'serializer'),
+}
+_CACHE_PAYLOAD_COLUMNS = tuple(_CACHE_FIELDS)
+
+
+def _cache_columns(db_path: str) -> set:
+    return {row['name'] for row in sqlite3_query('select name from pragma_table_info("__cache__")', db_path=db_path)}
+
 
 def _ensure_cache_table(db_path) -> None:
-    sqlite3_execute('CREATE TABLE IF NOT EXISTS __cache__ (key TEXT PRIMARY KEY, value TEXT, data JSON)', db_path=db_path)
+    db_path = db_path or _DEFAULT_DB_PATH
+    if db_path in _CACHE_TABLE_READY:
+        return
+    with _CACHE_TABLE_LOCK:
+        if db_path in _CACHE_TABLE_READY:
+            return
+        sqlite3_execute('CREATE TABLE IF NOT EXISTS __cache__ (key TEXT PRIMARY KEY, value TEXT, data JSON)', db_path=db_path)
+        if not _CACHE_COLUMNS.keys() <= _cache_columns(db_path):
+            with _connection(db_path) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                existing = _cache_columns(db_path)      # again under the write lock, other processes may have migrated
+                for column, type_ in _CACHE_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f'ALTER TABLE __cache__ ADD COLUMN {column} {type_}')
+                conn.commit()
+        sqlite3_execute('CREATE INDEX IF NOT EXISTS __cache_expires_at__ ON __cache__ (expires_at) WHERE expires_at IS NOT NULL', db_path=db_path)
+        sqlite3_execute('CREATE INDEX IF NOT EXISTS __cache_atime__ ON __cache__ (atime)', db_path=db_path)
+        _CACHE_TABLE_READY.add(db_path)
+
+
+_IN_CHUNK_SIZE = 500           # keys per "WHERE key IN (...)", well below SQLITE_MAX_VARIABLE_NUMBER
+_ALIVE = '(expires_at IS NULL OR expires_at > ?)'
+
+
+def _chunks(seq: list, size: int = _IN_CHUNK_SIZE):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _cache_select_many(conn: sqlite3.Connection, column: str, keys: List[str], now: float) -> Dict[str, sqlite3.Row]:
+    found = {}
+    fields = ', '.join(_CACHE_FIELDS[column])
+    for chunk in _chunks(keys):
+        sql = f'SELECT key, {fields}, expires_at FROM __cache__ WHERE key IN ({", ".join("?" * len(chunk))}) AND {_ALIVE}'
+        found.update((row['key'], row) for row in conn.execute(sql, (*chunk, now)))
+    return found
+
+
+def _cache_raw(column: str, row: Optional[sqlite3.Row]) -> Optional[tuple]:
+    return tuple(row[f] for f in _CACHE_FIELDS[column]) if row is not None else None
+
+
+def _cache_decode(column: str, raw: Optional[tuple]) -> Any:
+    if raw is None:
+        return None
+    if column == 'value':
+        return raw[0]
+    data, payload, codec, serializer = raw
+    if data is not None:
+        return json.loads(data)
+    if payload is None:
+        return None
+    if codec is not None:
+        payload = _codec(codec)[1](payload)
+    return _serializer(serializer or 'json')[1](payload)
+
+
+def _cache_encode_data(data: Any, db_path: str = None, serializer: str = None) -> tuple:
+    serializer = serializer or _SERIALIZERS_BY_DB.get(db_path or _DEFAULT_DB_PATH) or _SERIALIZERS_BY_DB.get(None, 'json')
+    codec, threshold = _compression(db_path)
+    if serializer == 'json':
+        text = json.dumps(data)
+        if codec is None or len(text) < threshold:
+            return text, None, None, None
+        return None, _codec(codec)[0](text.encode()), codec, None
+    payload = _serializer(serializer)[0](data)
+    if codec is None or len(payload) < threshold:
+        return None, payload, None, serializer
+    return None, _codec(codec)[0](payload), codec, serializer
+
+
+def _cache_upsert_sql(column: str) -> str:
+    fields = _CACHE_FIELDS[column]
+    # the other payload columns of an expired row must not come back to life
+    others = ''.join(
+        f', {f} = CASE WHEN __cache__.expires_at <= excluded.atime THEN NULL ELSE __cache__.{f} END'
+        for c in _CACHE_PAYLOAD_COLUMNS if c != column for f in _CACHE_FIELDS[c]
+    )
+    return (
+        f'INSERT INTO __cache__ (key, {", ".join(fields)}, expires_at, atime) VALUES (?, {"?, " * len(fields)}?, ?) '
+        f'ON CONFLICT(key) DO UPDATE SET {", ".join(f"{f} = excluded.{f}" for f in fields)}{others}, '
+        f'expires_at = excluded.expires_at, atime = excluded.atime'
+    )
 
 
-def sqlite3_connect(db_path=None) -> sqlite3.Connection:
+def _cache_upsert_many(items: Iterable[Tuple[str, Any]], column: str, db_path: str = None, ttl: float = None) -> List[Any]:
+    """Atomically set `column` of each key in __cache__ to the encoded items,
+    return the previous (decoded) contents in input order"""
+    _ensure_cache_table(db_path)
+    db_path = db_path or _DEFAULT_DB_PATH
+    items = list(items)
+    now = time.time()
+    expires_at = now + ttl if ttl is not None else None
+    write_behind = _WRITE_BEHIND.get(db_path)
+    previous = write_behind.put(items, column, expires_at) if write_behind is not None else None
+    if previous is not None:
+        _negative_cache_add(db_path, (k for k, _ in items))
+        return previous
+    u_sql = _cache_upsert_sql(column)
+    logger.debug(f'[{db_path}] Executing [{u_sql}] with {len(items)} params')
+    with _connection(db_path) as conn:
+        # RETURNING only sees the new rows, so the previous values are read under the same write lock
+        conn.execute('BEGIN IMMEDIATE')
+        rows = _cache_select_many(conn, column, list(dict.fromkeys(k for k, _ in items)), now)
+        conn.executemany(u_sql, ((k, *raw, expires_at, now) for k, raw in items))
+        conn.commit()
+    _MEMORY_CACHE.invalidate(db_path, (k for k, _ in items))
+    _negative_cache_add(db_path, (k for k, _ in items))
+    current = {k: _cache_raw(column, row) for k, row in rows.items()}
+    previous = []
+    for key, value in items:
+        previous.append(_cache_decode(column, current.get(key)))
+        current[key] = value
+    _cache_after_write(db_path, len(items))
+    return previous
+
+
+def _negative_cache_add(db_path: str, keys: Iterable[str]) -> None:
+    negative = _NEGATIVE_CACHES.get(db_path or _DEFAULT_DB_PATH)
+    if negative is not None:
+        negative.add(keys)
+
+
+def _negative_cache_discard(db_path: str, n: int) -> None:
+    negative = _NEGATIVE_CACHES.get(db_path or _DEFAULT_DB_PATH)
+    if negative is not None:
+        negative.discard(n)
+
+
+def _cache_upsert(key: str, column: str, value: Any, db_path: str = None, ttl: float = None) -> Any:
+    """Atomically set `column` of `key` in __cache__ and return its previous content"""
+    return _cache_upsert_many([(key, value)], column, db_path=db_path, ttl=ttl)[0]
+
+
+def _cache_get_many(keys: Iterable[str], column: str, db_path: str = None) -> List[Any]:
+    """Read and decode `column` of keys, seeing pending write-behind writes first,
+    then the in-memory cache when it is enabled"""
+    _ensure_cache_table(db_path)
     db_path = db_path or _DEFAULT_DB_PATH
-    return sqlite3.connect(db_path)
+    keys = list(keys)
+    now = time.time()
+    result = {}
+    missing = list(dict.fromkeys(keys))
+    write_behind = _WRITE_BEHIND.get(db_path)
+    if write_behind is not None:
+        missing = write_behind.get_many(column, missing, now, result)
+    if missing:
+        with _connection(db_path) as conn:
+            generation = _MEMORY_CACHE.sync(conn, db_path)
+            touch = [] if _cache_policy(db_path) else None
+            missing = _MEMORY_CACHE.get_many(db_path, column, missing, now, result, touch)
+            if touch:
+                _cache_touch(conn, touch, now)     # hot keys are served from memory, keep them out of LRU eviction
+            negative = _negative_cache(db_path) if missing else None
+            if negative is not None:
+                maybe = negative.might_contain(conn, missing)
+                result.update((k, None) for k in set(missing).difference(maybe))
+                missing = maybe
+            if missing:
+                found = _cache_select_many(conn, column, missing, now)
+                if negative is not None:
+                    negative.record_false_positives(len(missing) - len(found))
+                if found and _cache_policy(db_path):
+                    _cache_touch(conn, list(found), now)
+                for k in missing:
+                    row = found.get(k)
+                    value = result[k] = _cache_decode(column, _cache_raw(column, row))
+                    _MEMORY_CACHE.put(db_path, column, k, value, row['expires_at'] if row is not None else None, generation)
+    return [result[k] for k in keys]
+
+
+def _cache_get(key: str, column: str, db_path: str = None) -> Any:
+    return _cache_get_many([key], column, db_path=db_path)[0]
+
+
+class _MemoryCache:
+    """Bounded LRU of decoded __cache__ values keyed by (db_path, column, key).
+
+    Local writes invalidate their keys. Writes through other connections
+    (other threads or processes) are detected with ``PRAGMA data_version``
+    and drop everything cached for that database. A generation counter per
+    db_path keeps a read that raced with an invalidation from being cached.
+    Cached values are shared, callers must not mutate them.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.invalidations = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()      # (db_path, column, key) -> (value, expires_at, last atime refresh)
+        self._generations = {}          # db_path -> int
+        self._versions = {}             # (thread ident, db_path) -> (conn, data_version)
+
+    def sync(self, conn: sqlite3.Connection, db_path: str) -> Optional[int]:
+        """Drop db_path if another connection committed since this one last looked, return its generation"""
+        if not self.maxsize:
+            return None
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        key = (threading.get_ident(), db_path)
+        last = self._versions.get(key)
+        self._versions[key] = (conn, version)
+        if last is None or last[0] is not conn or last[1] != version:
+            self.invalidate(db_path)
+        return self._generations.get(db_path, 0)
+
+    def get_many(self, db_path: str, column: str, keys: Iterable[str], now: float, out: dict, touch: List[str] = None) -> List[str]:
+        """Fill `out` with cached values, return the keys that were not cached.
+        Hits whose atime in the table is due for a refresh are appended to `touch` if given."""
+        if not self.maxsize:
+            return list(keys)
+        missing, hits = [], 0
+        with self._lock:
+            for k in keys:
+                entry = self._data.get((db_path, column, k))
+                if entry is None or (entry[1] is not None and entry[1] <= now):
+                    missing.append(k)
+                    continue
+                self._data.move_to_end((db_path, column, k))
+                out[k] = entry[0]
+                hits += 1
+                if touch is not None and entry[2] < now - _ATIME_RESOLUTION:
+                    self._data[(db_path, column, k)] = (entry[0], entry[1], now)
+                    touch.append(k)
+            self.hits += hits     # out may already hold values decided by write-behind
+            self.misses += len(missing)
+        return missing
+
+    def put(self, db_path: str, column: str, key: str, value: Any, expires_at: Optional[float], generation: Optional[int]) -> None:
+        if not self.maxsize:
+            return
+        with self._lock:
+            if self._generations.get(db_path, 0) != generation:
+                return
+            self._data[(db_path, column, key)] = (value, expires_at, time.time())     # read from the table, which touched it
+            self._data.move_to_end((db_path, column, key))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, db_path: str = None, keys: Iterable[str] = None) -> None:
+        """Forget `keys` of db_path, or everything cached for db_path if keys is None"""
+        if not self.maxsize:
+            return
+        db_path = db_path or _DEFAULT_DB_PATH
+        with self._lock:
+            self._generations[db_path] = self._generations.get(db_path, 0) + 1
+            self.invalidations += 1
+            if keys is None:
+                for k in [k for k in self._data if k[0] == db_path]:
+                    del self._data[k]
+            else:
+                for k in keys:
+                    for column in _CACHE_PAYLOAD_COLUMNS:
+                        self._data.pop((db_path, column, k), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generations = {db_path: g + 1 for db_path, g in self._generations.items()}
+
+    def info(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+_MEMORY_CACHE = _MemoryCache(int(os.getenv('QQUTILS_SQLITE_MEMORY_CACHE', 0)))
+
+
+# Negative cache
+
+class _NegativeCache:
+    """Bloom filter of the keys in the __cache__ table of one db_path.
+
+    Built from a key scan on first use and updated by local writes, so a key
+    missing from the filter is a definite miss answered without a lookup.
+    Deleted keys stay in the filter (costing false positives) until more than
+    `rebuild_ratio` of its keys were deleted, then it is rebuilt. When
+    ``PRAGMA data_version`` shows a commit through another connection (another
+    thread or process), the rows inserted since the last look are added from a
+    rowid watermark; the filter is only rebuilt if the watermark row is gone,
+    as SQLite may then reuse rowids below it. sqlite3_execute drops the filter.
+    """
+
+    MIN_CAPACITY = 1024
+
+    def __init__(self, db_path: str, fp_rate: float, rebuild_ratio: float):
+        self.db_path = db_path
+        self.fp_rate = fp_rate
+        self.rebuild_ratio = rebuild_ratio
+        self.lookups = self.skips = self.false_positives = self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._capacity = self._keys = self._deletes = self._bits = self._hashes = 0
+        self._watermark = (0, None)     # (rowid, key) of the newest row already in the filter
+        self._versions = {}             # thread ident -> (conn, data_version)
+
+    def _sync(self, conn: sqlite3.Connection) -> None:
+        # same check as _MemoryCache.sync: the filter may miss keys committed elsewhere
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        last = self._versions.get(threading.get_ident())
+        self._versions[threading.get_ident()] = (conn, version)
+        if self._bloom is not None and (last is None or last[0] is not conn or last[1] != version):
+            self._catch_up(conn)
+
+    def _catch_up(self, conn: sqlite3.Connection) -> None:
+        rowid, key = self._watermark
+        if rowid and conn.execute('SELECT 1 FROM __cache__ WHERE rowid = ? AND key = ?', (rowid, key)).fetchone() is None:
+            self._bloom = None      # newest rows deleted, new keys may have taken rowids below the watermark
+            return
+        rows = conn.execute('SELECT rowid, key FROM __cache__ WHERE rowid > ? ORDER BY rowid', (rowid,)).fetchall()
+        if rows:
+            self._add([row[1] for row in rows])
+            self._watermark = tuple(rows[-1])
+
+    def _build(self, conn: sqlite3.Connection) -> None:
+        from .bloom_filter import BloomFilter
+        write_behind = _WRITE_BEHIND.get(self.db_path)
+        pending = write_behind.keys() if write_behind is not None else []   # before the scan, keys move on to the table
+        # before the scan too, rows committed meanwhile are caught up later
+        top = conn.execute('SELECT rowid, key FROM __cache__ ORDER BY rowid DESC LIMIT 1').fetchone()
+        self._watermark = tuple(top) if top is not None else (0, None)
+        count = conn.execute('SELECT count(*) FROM __cache__').fetchone()[0] + len(pending)
+        self._capacity = max(2 * count, self.MIN_CAPACITY)
+        self._bloom = BloomFilter.for_capacity(self._capacity, self.fp_rate)
+        self._bits, self._hashes = len(self._bloom.mem), self._bloom.n_hashes
+        self._bloom.add_many(itertools.chain((row[0] for row in conn.execute('SELECT key FROM __cache__')), pending))
+        self._keys, self._deletes = count, 0
+        self.rebuilds += 1
+        logger.debug(f'[{self.db_path}] Built negative cache of {self._keys} keys ({self._bits} bits, {self._hashes} hashes)')
+
+    def might_contain(self, conn: sqlite3.Connection, keys: List[str]) -> List[str]:
+        """Return the keys that may be in the table, building the filter first if needed"""
+        with self._lock:
+            self._sync(conn)
+            if self._bloom is None:
+                self._build(conn)
+            maybe = [k for k, hit in zip(keys, self._bloom.contains_many(keys)) if hit]
+            self.lookups += len(keys)
+            self.skips += len(keys) - len(maybe)
+        return maybe
+
+    def record_false_positives(self, n: int) -> None:
+        with self._lock:
+            self.false_positives += n
+
+    def add(self, keys: Iterable[str]) -> None:
+        """Called after keys were written (committed or queued for write-behind)"""
+        with self._lock:
+            if self._bloom is not None:
+                self._add(list(keys))
+
+    def _add(self, keys: List[str]) -> None:
+        new = [k for k, hit in zip(keys, self._bloom.contains_many(keys)) if not hit]     # overwrites do not fill the filter
+        self._bloom.add_many(new)
+        self._keys += len(new)
+        if self._keys > self._capacity:
+            self._bloom = None          # rebuild bigger on next use
+
+    def discard(self, n: int) -> None:
+        """Called after n keys were deleted"""
+        with self._lock:
+            self._deletes += n
+            if self._bloom is not None and self._deletes > self.rebuild_ratio * self._keys:
+                self._bloom = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._bloom = None
+
+    def info(self) -> dict:
+        from .bloom_filter import BloomFilter
+        absent = self.skips + self.false_positives
+        return {
+            'lookups': self.lookups,
+            'skips': self.skips,
+            'false_positives': self.false_positives,
+            'skip_rate': self.skips / self.lookups if self.lookups else 0.0,
+            'fp_rate': self.false_positives / absent if absent else 0.0,
+            'estimated_fp_rate': BloomFilter.estimate_false_positive_rate(self._hashes, self._bits, self._keys) if self._bits else 0.0,
+            'keys': self._keys,
+            'capacity': self._capacity,
+            'bits': self._bits,
+            'hashes': self._hashes,
+            'rebuilds': self.rebuilds,
+        }
+
+
+_NEGATIVE_CACHE_SETTINGS: Dict[Optional[str], Tuple[float, float]] = {}    # db_path (None for all) -> (fp_rate, rebuild_ratio)
+_NEGATIVE_CACHES: Dict[str, _NegativeCache] = {}
+_NEGATIVE_CACHES_LOCK = threading.Lock()
+
+
+def _negative_cache(db_path: str = None) -> Optional[_NegativeCache]:
+    """The negative cache of db_path, created (not built) if enabled"""
+    db_path = db_path or _DEFAULT_DB_PATH
+    cache = _NEGATIVE_CACHES.get(db_path)
+    if cache is not None:
+        return cache
+    settings = _NEGATIVE_CACHE_SETTINGS.get(db_path) or _NEGATIVE_CACHE_SETTINGS.get(None)
+    if settings is None:
+        return None
+    with _NEGATIVE_CACHES_LOCK:
+        return _NEGATIVE_CACHES.setdefault(db_path, _NegativeCache(db_path, *settings))
+
+
+# Compression and serialization
+
+_CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+_COMPRESSION: Dict[Optional[str], Tuple[Optional[str], int]] = {}     # db_path (None for all) -> (codec, threshold)
+
+# json is stored as text in the data column (queryable), the others as bytes in payload
+_SERIALIZERS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    'json': (lambda obj: json.dumps(obj).encode(), json.loads),
+    'pickle': (partial(pickle.dumps, protocol=5), pickle.loads),
+    'marshal': (marshal.dumps, marshal.loads),
+}
+_SERIALIZERS_BY_DB: Dict[Optional[str], str] = {}     # db_path (None for all) -> serializer
+
+
+def _codec(name: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unknown codec {name!r}, register it with sqlite3_register_codec') from None
+
+
+def _serializer(name: str) -> Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]:
+    try:
+        return _SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f'Unknown serializer {name!r}, register it with sqlite3_register_serializer') from None
+
+
+def _compression(db_path: str = None) -> Tuple[Optional[str], int]:
+    db_path = db_path or _DEFAULT_DB_PATH
+    return _COMPRESSION.get(db_path) or _COMPRESSION.get(None) or (None, 0)
+
+
+# Write-behind
+
+class _WriteBehind:
+    """Buffer __cache__ writes of one db_path in memory and commit them in groups.
+
+    A background thread commits every `interval` seconds, or as soon as
+    `max_batch` keys are pending; within a group the last write of a key
+    wins. Reads consult the buffer (and the group being committed) before
+    the database. Pending writes are flushed at exit.
+    """
+
+    def __init__(self, db_path: str, interval: float, max_batch: int):
+        self.db_path = db_path
+        self.interval = interval
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = {}      # key -> {'deleted': bool, 'columns': {column: raw}, 'expires_at': float}
+        self._flushing = {}
+        self._closed = False
+        self._drained = threading.Event()     # set once close() committed everything buffered
+        self._thread = threading.Thread(target=self._run, name=f'sqlite3-write-behind-{os.path.basename(db_path)}', daemon=True)
+        self._thread.start()
+
+    def _lookup(self, key: str, column: str) -> Tuple[bool, Optional[tuple], Optional[float]]:
+        # (decided, raw, expires_at) of column: the pending entry first, then the group being
+        # committed unless the pending entry deletes the key; the row expires as the newest entry says
+        pending, flushing = self._pending.get(key), self._flushing.get(key)
+        for entry in (pending, flushing):
+            if entry is None:
+                continue
+            if column in entry['columns']:
+                return True, entry['columns'][column], (pending or entry)['expires_at']
+            if entry['deleted']:
+                return True, None, None
+        return False, None, None
+
+    def keys(self) -> List[str]:
+        """Keys written but not committed yet"""
+        with self._cond:
+            return [k for k, e in {**self._flushing, **self._pending}.items() if not e['deleted'] or e['columns']]
+
+    def get_many(self, column: str, keys: List[str], now: float, out: dict) -> List[str]:
+        """Fill `out` with values decided by pending writes, return the keys to read from the database"""
+        missing = []
+        with self._cond:
+            for k in keys:
+                decided, raw, expires_at = self._lookup(k, column)
+                if not decided:
+                    missing.append(k)
+                elif raw is not None and (expires_at is None or expires_at > now):
+                    out[k] = _cache_decode(column, raw)
+                else:
+                    out[k] = None
+        return missing
+
+    def _refuse(self) -> bool:
+        # writes racing with close() are committed directly by the caller,
+        # after the buffered ones so that they are not overwritten
+        if not self._closed:
+            return False
+        self._cond.release()
+        try:
+            self._drained.wait()
+        finally:
+            self._cond.acquire()
+        return True
+
+    def put(self, items: List[Tuple[str, Any]], column: str, expires_at: Optional[float]) -> Optional[List[Any]]:
+        """Buffer the writes and return the previous values, or None if the buffer is closed"""
+        keys = list(dict.fromkeys(k for k, _ in items))
+        with self._cond:
+            if self._refuse():
+                return None
+            unknown = self.get_many(column, keys, time.time(), {})
+        # keys without a pending write of column: read their previous value outside the lock
+        current = dict(zip(unknown, _cache_get_many(unknown, column, self.db_path))) if unknown else {}
+        previous = []
+        with self._cond:
+            if self._refuse():
+                return None
+            now = time.time()
+            self.get_many(column, keys, now, current)
+            for key, value in items:
+                previous.append(current.get(key))
+                current[key] = _cache_decode(column, value)
+                entry = self._pending.setdefault(key, {'deleted': False, 'columns': {}, 'expires_at': None})
+                if entry['expires_at'] is not None and entry['expires_at'] <= now:
+                    # the buffered row expired: like the upsert of an expired row, drop its other columns
+                    entry = self._pending[key] = {'deleted': True, 'columns': {}, 'expires_at': None}
+                entry['columns'][column] = value
+                entry['expires_at'] = expires_at
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return previous
+
+    def delete(self, keys: List[str]) -> bool:
+        """Buffer the deletes, return False if the buffer is closed"""
+        with self._cond:
+            if self._refuse():
+                return False
+            for key in keys:
+                self._pending[key] = {'deleted': True, 'columns': {}, 'expires_at': None}
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return True
+
+    def flush(self) -> int:
+        """Commit pending writes now in one transaction, return the number of keys written"""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+            batch = self._flushing
+            now = time.time()
+            deletes = [(k,) for k, e in batch.items() if e['deleted']]
+            upserts = {c: [] for c in _CACHE_PAYLOAD_COLUMNS}
+            for k, e in batch.items():
+                for column, raw in e['columns'].items():
+                    upserts[column].append((k, *raw, e['expires_at'], now))
+            try:
+                with _connection(self.db_path) as conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany('DELETE FROM __cache__ WHERE key = ?', deletes)
+                    for column, params in upserts.items():
+                        if params:
+                            conn.executemany(_cache_upsert_sql(column), params)
+                    conn.commit()
+            except Exception:
+                logger.exception(f'[{self.db_path}] Failed to flush {len(batch)} pending writes, will retry')
+                with self._cond:
+                    self._pending = self._requeue(batch, self._pending)
+                    self._flushing = {}
+                return 0
+            _MEMORY_CACHE.invalidate(self.db_path, batch)
+            with self._cond:
+                self._flushing = {}
+            logger.debug(f'[{self.db_path}] Flushed {len(batch)} pending writes')
+        _cache_after_write(self.db_path, len(batch))
+        return len(batch)
+
+    @staticmethod
+    def _requeue(failed: dict, newer: dict) -> dict:
+        # put the failed group back under the writes made meanwhile, column by column:
+        # a newer delete supersedes the failed entry, a newer put only the columns it wrote
+        merged = dict(failed)
+        for key, entry in newer.items():
+            old = failed.get(key)
+            if old is not None and not entry['deleted']:
+                entry = {'deleted': old['deleted'], 'columns': {**old['columns'], **entry['columns']}, 'expires_at': entry['expires_at']}
+            merged[key] = entry
+        return merged
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.max_batch:
+                    self._cond.wait(self.interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        try:
+            self.flush()
+        finally:
+            self._drained.set()
+
+
+_WRITE_BEHIND: Dict[str, _WriteBehind] = {}     # db_path -> buffer
+_WRITE_BEHIND_LOCK = threading.Lock()
+
+
+@atexit.register
+def _flush_write_behind_at_exit():
+    for write_behind in list(_WRITE_BEHIND.values()):
+        write_behind.close()
+
+
+def _flush_pending(db_path: str = None) -> None:
+    write_behind = _WRITE_BEHIND.get(db_path or _DEFAULT_DB_PATH)
+    if write_behind is not None:
+        write_behind.flush()
+
+
+# Eviction
+
+_CACHE_POLICIES: Dict[str, dict] = {}      # db_path -> {'max_entries', 'max_bytes', 'purge_every', ...}
+_CACHE_WRITES: Dict[str, int] = {}         # db_path -> writes since the last automatic purge
+_ATIME_RESOLUTION = 1.0                    # seconds, avoid rewriting atime of hot keys on every read
+# length() of TEXT counts characters, cast to BLOB to count bytes
+_ROW_BYTES = ('coalesce(length(CAST(value AS BLOB)), 0) + coalesce(length(CAST(data AS BLOB)), 0) '
+              '+ coalesce(length(payload), 0) + length(CAST(key AS BLOB))')
+_PURGE_LOCKS: Dict[str, threading.Lock] = {}   # db_path -> lock serializing purges in this process
+_AUTO_PURGES = set()                           # db_paths with a background purge running
+_PURGE_LOCK = threading.Lock()
+
+
+def _cache_policy(db_path: str) -> Optional[dict]:
+    return _CACHE_POLICIES.get(db_path or _DEFAULT_DB_PATH)
+
+
+def _cache_touch(conn: sqlite3.Connection, keys: List[str], now: float) -> None:
+    for chunk in _chunks(keys):
+        sql = f'UPDATE __cache__ SET atime = ? WHERE key IN ({", ".join("?" * len(chunk))}) AND (atime IS NULL OR atime < ?)'
+        conn.execute(sql, (now, *chunk, now - _ATIME_RESOLUTION))
+    conn.commit()
+
+
+def _cache_after_write(db_path: str, n: int) -> None:
+    policy = _cache_policy(db_path)
+    if not policy:
+        return
+    db_path = db_path or _DEFAULT_DB_PATH
+    writes = _CACHE_WRITES.get(db_path, 0) + n
+    if writes < policy['purge_every']:
+        _CACHE_WRITES[db_path] = writes
+        return
+    with _PURGE_LOCK:
+        if db_path in _AUTO_PURGES:
+            _CACHE_WRITES[db_path] = writes     # retried by the running purge when it ends
+            return
+        _AUTO_PURGES.add(db_path)
+        _CACHE_WRITES[db_path] = 0
+    submit_daemon_thread(_auto_purge, db_path, policy['batch_size'])
+
+
+def _auto_purge(db_path: str, batch_size: int) -> None:
+    """Purge off the writer's thread until the table is within the policy, measuring it takes a full scan"""
+    try:
+        while sqlite3_purge(db_path=db_path, batch_size=batch_size):
+            pass    # rows written during the purge were not measured
+    except Exception:
+        logger.exception(f'[{db_path}] Automatic purge failed')
+    finally:
+        with _PURGE_LOCK:
+            _AUTO_PURGES.discard(db_path)
+    _cache_after_write(db_path, 0)
+
+
+def _purge_lock(db_path: str) -> threading.Lock:
+    with _PURGE_LOCK:
+        return _PURGE_LOCKS.setdefault(db_path, threading.Lock())
+
+
+def _cache_totals(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """(rows, bytes) of __cache__, read without taking the write lock"""
+    rows, size = conn.execute(f'SELECT count(*), coalesce(sum({_ROW_BYTES}), 0) FROM __cache__').fetchall()[0]
+    return rows, size
+
+
+def _cache_excess(policy: dict, rows: int, size: int, batch_size: int) -> int:
+    """Number of LRU rows to evict in the next batch"""
+    excess = 0
+    if policy.get('max_entries') is not None:
+        excess = max(rows - policy['max_entries'], 0)
+    if policy.get('max_bytes') is not None and size > policy['max_bytes']:
+        excess = batch_size
+    return min(excess, batch_size)
+
+
+def _items(mapping: Union[Mapping[str, Any], Iterable[Tuple[str, Any]]]) -> Iterable[Tuple[str, Any]]:
+    return mapping.items() if isinstance(mapping, Mapping) else mapping
+
+
+def sqlite3_connect(db_path=None, profile: Union[str, dict] = None) -> sqlite3.Connection:
+    """Open a new (unpooled) connection, the caller is responsible for closing it"""
+    db_path = db_path or _DEFAULT_DB_PATH
+    return _open(db_path, _profile_pragmas(profile) if profile else None)
+
+
+def sqlite3_set_profile(profile: Union[str, dict, None], db_path: str = None) -> None:
+    """Select the PRAGMA profile ('durable', 'fast', 'readonly', a dict of PRAGMAs, or None for
+    SQLite defaults) for db_path, or for every database without its own profile if db_path is None.
+    Defaults to the QQUTILS_SQLITE_PROFILE environment variable.
+    Pooled connections pick up the new profile the next time their thread uses them.
+    """
+    _profile_pragmas(profile)   # validate
+    _DB_PROFILES[db_path] = profile
+
+
+def sqlite3_close_all(db_path: str = None) -> int:
+    """Close pooled connections of all threads (only those to db_path if given), return how many were closed"""
+    return _POOL.close_all(db_path)
+
+
+def sqlite3_set_max_idle(seconds: Optional[float]) -> None:
+    """Close pooled connections unused for more than `seconds` (None to keep them open forever)"""
+    _POOL.max_idle = seconds
 
 
 def sqlite3_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
@@ -52,29 +1005,81 @@ def sqlite3_execute(sql: str, params: Iterable[Any] = None, *, db_path: str = No
     db_path = db_path or _DEFAULT_DB_PATH
     # assert 'select' not in sql.lower(), 'Use sqlite3_query instead'
     logger.debug(f'[{db_path}] Executing [{sql}] with params {params}')
-    with closing(sqlite3.connect(db_path)) as conn:
+    with _connection(db_path) as conn:
         with closing(conn.cursor()) as cursor:
             if params:
                 cursor.execute(sql, params)
             else:
                 cursor.execute(sql)
         conn.commit()
+    _MEMORY_CACHE.invalidate(db_path)   # data_version does not see changes made through this connection
+    negative = _NEGATIVE_CACHES.get(db_path)
+    if negative is not None:
+        negative.invalidate()
 
 
 def sqlite3_query(sql: str, params: Iterable[Any] = None, *, db_path: str = None) -> list:
     db_path = db_path or _DEFAULT_DB_PATH
     assert 'select' in sql.lower(), 'Use sqlite3_execute instead'
     logger.debug(f'[{db_path}] Quering [{sql}] with params {params}')
-    with closing(sqlite3.connect(db_path)) as conn:
-        conn.row_factory = sqlite3.Row
+    with _connection(db_path) as conn:
         with closing(conn.cursor()) as cursor:
             if params:
-                rows = cursor.execute(sql, params).fetchall()
+                rows = cursor.execute(sql, params)
             else:
-                rows = cursor.execute(sql).fetchall()
+                rows = cursor.execute(sql)
             return [dict(row) for row in rows]
 
 
+def _row_maker(cursor: sqlite3.Cursor, row_type: str) -> Callable[[tuple], Any]:
+    columns = [d[0] for d in cursor.description or ()]
+    if row_type == 'tuple':
+        return tuple
+    if row_type == 'dict':
+        return lambda row: dict(zip(columns, row))
+    if row_type == 'namedtuple':
+        return namedtuple('Row', columns, rename=True)._make
+    raise ValueError(f"row_type should be 'tuple', 'dict' or 'namedtuple', got {row_type!r}")
+
+
+def sqlite3_iter_query(
+        sql: str,
+        params: Iterable[Any] = None,
+        *,
+        db_path: str = None,
+        batch_size: int = 1000,
+        row_type: str = 'dict',
+) -> Iterator[Any]:
+    """Lazily yield the rows of a query, fetching `batch_size` rows at a time.
+
+    The query runs on its own connection, which is closed once the generator
+    is exhausted, closed or garbage collected. `row_type` is one of
+    'tuple', 'dict' or 'namedtuple'.
+    """
+    db_path = db_path or _DEFAULT_DB_PATH
+    assert 'select' in sql.lower(), 'Use sqlite3_execute instead'
+    logger.debug(f'[{db_path}] Iterating [{sql}] with params {params}')
+    with closing(_open(db_path)) as conn:
+        with closing(conn.cursor()) as cursor:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            make_row = _row_maker(cursor, row_type)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield make_row(row)
+
+
+def sqlite3_iter_table(table: str, *, db_path: str = None, batch_size: int = 1000, row_type: str = 'dict') -> Iterator[Any]:
+    """Lazily yield all rows of `table`, see sqlite3_iter_query"""
+    sql = f'select * from "{table}"'
+    return sqlite3_iter_query(sql, db_path=db_path, batch_size=batch_size, row_type=row_type)
+
+
 def sqlite3_select_all(table, db_path: str = None) -> dict:
     db_path = db_path or _DEFAULT_DB_PATH
     sql = f'select * from "{table}"'
@@ -101,101 +1106,940 @@ def sqlite3_tables(db_path: str = None):
 
 def sqlite3_get(key: str, *, db_path: str = None, cast=str) -> Any:
     """Use SQLite to store key-value pairs"""
-    _ensure_cache_table(db_path)
-    sql = 'select value from __cache__ where key = ?'
-    records = sqlite3_query(sql, (key,), db_path=db_path)
-    logger.debug(f'[{db_path}] Quering [{sql}] with params {key}, got {records}')
-    return cast(records[-1]['value']) if records else None
+    value = _cache_get(key, 'value', db_path=db_path)
+    return cast(value) if value is not None else None
 
 
 def sqlite3_delete(key: str, *, db_path: str = None) -> None:
     """Use SQLite to delete a key-value pair"""
-    _ensure_cache_table(db_path)
-    del_sql = 'DELETE FROM __cache__ WHERE key = ?'
-    logger.debug(f'[{db_path}] Executing [{del_sql}] with params {key}')
-    sqlite3_execute(del_sql, (key,), db_path=db_path)
-
-
-def sqlite3_put(key: str, value: Any, *, db_path: str = None) -> str:
-    """Use SQLite to store key-value pairs"""
-    _ensure_cache_table(db_path)
+    sqlite3_delete_many([key], db_path=db_path)
 
-    q_sql = 'select value from __cache__ where key = ?'
-    records = sqlite3_query(q_sql, (key,), db_path=db_path)
 
-    if not records:
-        u_sql = 'INSERT INTO __cache__ (key, value) VALUES (?, ?)'
-        params = (key, value)
-        ret = None
-    else:
-        u_sql = 'UPDATE __cache__ SET value = ? WHERE key = ?'
-        params = (value, key)
-        # print(records)
-        ret = records[-1]['value']
-    logger.debug(f'[{db_path}] Executing [{u_sql}] with params {params}')
-    sqlite3_execute(u_sql, params, db_path=db_path)
-    return ret
+def sqlite3_put(key: str, value: Any, *, db_path: str = None, ttl: float = None) -> str:
+    """Use SQLite to store key-value pairs, return the previous value.
+    The row expires `ttl` seconds from now (never if None)."""
+    return _cache_upsert(key, 'value', (value,), db_path=db_path, ttl=ttl)
 
 
 def sqlite3_jget(key: str, *, db_path: str = None) -> Optional[dict]:
     """Use SQLite to fetch key-value pairs by key as JSON"""
-    _ensure_cache_table(db_path)
-    sql = 'select data from __cache__ where key = ?'
-    records = sqlite3_query(sql, (key,), db_path=db_path)
-    logger.debug(f'[{db_path}] Quering [{sql}] with params {key}, got {records}')
-    return json.loads(records[-1]['data']) if records else None
+    return _cache_get(key, 'data', db_path=db_path)
 
 
 def sqlite3_jget_all(db_path: str = None) -> List[Dict]:
-    """Use SQLite to fetch all key-value pairs as JSON"""
+    """Use SQLite to fetch all key-value pairs as JSON (use sqlite3_iter_table('__cache__') for large tables)"""
     _ensure_cache_table(db_path)
-    sql = 'select * from __cache__'
-    records = sqlite3_query(sql, None, db_path=db_path)
+    _flush_pending(db_path)
+    sql = f'select * from __cache__ where {_ALIVE}'
+    records = list(sqlite3_iter_query(sql, (time.time(),), db_path=db_path))
+    for r in records:
+        if r['codec'] is not None:
+            r['payload'], r['codec'] = _codec(r['codec'])[1](r['payload']), None
+        if r['serializer'] is None and r['payload'] is not None:     # give back the JSON text
+            r['data'], r['payload'] = r['payload'].decode(), None
     logger.debug(f'[{db_path}] Quering [{sql}], got {len(records)} records')
     return records
 
 
-def sqlite3_jput(key: str, data: dict, *, db_path: str = None) -> Optional[dict]:
-    """Use SQLite to store key-value pairs as JSON"""
+def sqlite3_jput(key: str, data: dict, *, db_path: str = None, ttl: float = None, serializer: str = None) -> Optional[dict]:
+    """Use SQLite to store key-value pairs as JSON, return the previous data.
+    The row expires `ttl` seconds from now (never if None).
+    `serializer` ('json', 'pickle', 'marshal' or a registered one) overrides the database default."""
+    return _cache_upsert(key, 'data', _cache_encode_data(data, db_path, serializer), db_path=db_path, ttl=ttl)
+
+
+def sqlite3_get_many(keys: Iterable[str], *, db_path: str = None, cast=str) -> List[Any]:
+    """Batch sqlite3_get, values are returned in the order of keys (None if missing)"""
+    return [cast(v) if v is not None else None for v in _cache_get_many(keys, 'value', db_path=db_path)]
+
+
+def sqlite3_put_many(mapping: Union[Mapping[str, Any], Iterable[Tuple[str, Any]]], *, db_path: str = None, ttl: float = None) -> List[str]:
+    """Batch sqlite3_put in a single transaction, return the previous values in input order"""
+    return _cache_upsert_many(((k, (v,)) for k, v in _items(mapping)), 'value', db_path=db_path, ttl=ttl)
+
+
+def sqlite3_jget_many(keys: Iterable[str], *, db_path: str = None) -> List[Optional[dict]]:
+    """Batch sqlite3_jget, data are returned in the order of keys (None if missing)"""
+    return _cache_get_many(keys, 'data', db_path=db_path)
+
+
+def sqlite3_jput_many(
+        mapping: Union[Mapping[str, dict], Iterable[Tuple[str, dict]]],
+        *,
+        db_path: str = None,
+        ttl: float = None,
+        serializer: str = None,
+) -> List[Optional[dict]]:
+    """Batch sqlite3_jput in a single transaction, return the previous data in input order"""
+    items = [(k, _cache_encode_data(v, db_path, serializer)) for k, v in _items(mapping)]
+    return _cache_upsert_many(items, 'data', db_path=db_path, ttl=ttl)
+
+
+def sqlite3_delete_many(keys: Iterable[str], *, db_path: str = None) -> int:
+    """Batch sqlite3_delete in a single transaction, return the number of deleted keys
+    (the number of keys scheduled for deletion in write-behind mode)"""
+    _ensure_cache_table(db_path)
+    keys = list(dict.fromkeys(keys))
+    write_behind = _WRITE_BEHIND.get(db_path or _DEFAULT_DB_PATH)
+    if write_behind is not None and write_behind.delete(keys):
+        _negative_cache_discard(db_path, len(keys))
+        return len(keys)
+    deleted = 0
+    with _connection(db_path) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        for chunk in _chunks(keys):
+            sql = f'DELETE FROM __cache__ WHERE key IN ({", ".join("?" * len(chunk))})'
+            deleted += conn.execute(sql, chunk).rowcount
+        conn.commit()
+    _MEMORY_CACHE.invalidate(db_path, keys)
+    _negative_cache_discard(db_path, deleted)
+    return deleted
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    """Smallest string greater than every string starting with prefix (None if unbounded)"""
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    # surrogates cannot be encoded to UTF-8, the next key after U+D7FF is U+E000
+    return prefix[:-1] + chr(0xE000 if 0xD800 <= code <= 0xDFFF else code)
+
+
+def sqlite3_scan(
+        prefix: str = None,
+        *,
+        start: str = None,
+        end: str = None,
+        limit: int = None,
+        reverse: bool = False,
+        column: Optional[str] = None,
+        db_path: str = None,
+        batch_size: int = 1000,
+) -> Iterator[Any]:
+    """Lazily yield the keys starting with `prefix` and within [start, end), in key order
+    (descending if reverse). With column='value' or 'data' yield (key, value) pairs instead,
+    decoded as sqlite3_get/sqlite3_jget would.
+
+    Runs as a range search on the key index (``key >= ? AND key < ?``), e.g.
+    ``sqlite3_scan('tenant:123:')`` lists one tenant without reading the whole table.
+    Pages of `batch_size` keys are read by short queries after the last key seen, so no
+    read lock is held between pages and the caller may write to the table while iterating.
+    """
+    lower, upper = start, end
+    if prefix:
+        lower = max(prefix, start) if start is not None else prefix
+        prefix_end = _prefix_end(prefix)
+        if prefix_end is not None:
+            upper = min(prefix_end, end) if end is not None else prefix_end
+    if lower is not None and upper is not None and lower >= upper:
+        return
+    _ensure_cache_table(db_path)
+    _flush_pending(db_path)
+    now = time.time()
+    fields = ''.join(f', {f}' for f in _CACHE_FIELDS[column]) if column else ''
+    after = None        # last key seen going forward, going backward it becomes the upper bound
+    while limit is None or limit > 0:
+        conditions, params = [_ALIVE], [now]
+        if after is not None:
+            conditions.append('key > ?')
+            params.append(after)
+        elif lower is not None:
+            conditions.append('key >= ?')
+            params.append(lower)
+        if upper is not None:
+            conditions.append('key < ?')
+            params.append(upper)
+        page = batch_size if limit is None else min(batch_size, limit)
+        sql = (f'SELECT key{fields} FROM __cache__ WHERE {" AND ".join(conditions)} '
+               f'ORDER BY key {"DESC" if reverse else "ASC"} LIMIT ?')
+        with _connection(db_path) as conn:
+            rows = conn.execute(sql, (*params, page)).fetchall()
+        for row in rows:
+            yield (row[0], _cache_decode(column, tuple(row)[1:])) if column else row[0]
+        if len(rows) < page:
+            return
+        if limit is not None:
+            limit -= len(rows)
+        if reverse:
+            upper = rows[-1][0]
+        else:
+            after = rows[-1][0]
+
+
+def sqlite3_set_cache_policy(
+        max_entries: int = None,
+        max_bytes: int = None,
+        *,
+        db_path: str = None,
+        purge_every: int = 1000,
+        batch_size: int = 500,
+) -> None:
+    """Bound the __cache__ table of db_path, evicting least recently used rows.
+
+    Once set, reads keep an access time per row and every `purge_every` writes
+    a background thread purges, `batch_size` rows per transaction, until the
+    table is within the limits again. Call with no limits to remove the policy.
+    """
+    db_path = db_path or _DEFAULT_DB_PATH
+    if max_entries is None and max_bytes is None:
+        _CACHE_POLICIES.pop(db_path, None)
+        return
+    _CACHE_POLICIES[db_path] = {
+        'max_entries': max_entries,
+        'max_bytes': max_bytes,
+        'purge_every': purge_every,
+        'batch_size': batch_size,
+    }
+
+
+def sqlite3_purge(*, db_path: str = None, batch_size: int = 500, max_batches: int = None) -> int:
+    """Delete expired rows, then least recently used rows while over the cache policy.
+
+    Rows are deleted `batch_size` at a time, each batch in its own short
+    transaction so that writers are never blocked for long. The table is
+    measured once, before any write lock is taken, and the deleted rows are
+    subtracted as batches go. Stops after `max_batches` batches if given.
+    Return the number of deleted rows.
+    """
     _ensure_cache_table(db_path)
+    _flush_pending(db_path)
+    db_path = db_path or _DEFAULT_DB_PATH
+    policy = _cache_policy(db_path)
+    deleted = batches = 0
+    expired_sql = f'DELETE FROM __cache__ WHERE key IN (SELECT key FROM __cache__ WHERE expires_at <= ? LIMIT ?) RETURNING {_ROW_BYTES}'
+    lru_sql = f'DELETE FROM __cache__ WHERE key IN (SELECT key FROM __cache__ ORDER BY atime LIMIT ?) RETURNING {_ROW_BYTES}'
+    with _purge_lock(db_path), _connection(db_path) as conn:
+        rows, size = _cache_totals(conn) if policy else (0, 0)
+        while max_batches is None or batches < max_batches:
+            conn.execute('BEGIN IMMEDIATE')
+            sizes = conn.execute(expired_sql, (time.time(), batch_size)).fetchall()
+            if not sizes and policy:
+                excess = _cache_excess(policy, rows, size, batch_size)
+                sizes = conn.execute(lru_sql, (excess,)).fetchall() if excess else []
+            conn.commit()
+            if not sizes:
+                break
+            time.sleep(0)   # yield to writers between batches
+            rows -= len(sizes)
+            size -= sum(r[0] for r in sizes)
+            deleted += len(sizes)
+            batches += 1
+            _MEMORY_CACHE.invalidate(db_path)
+    _negative_cache_discard(db_path, deleted)
+    logger.debug(f'[{db_path}] Purged {deleted} rows from __cache__ in {batches} batches')
+    return deleted
+
+
+def sqlite3_set_memory_cache(maxsize: int) -> None:
+    """Serve sqlite3_get/sqlite3_jget (and their batch variants) from an in-process LRU of
+    `maxsize` decoded values, 0 to disable. Defaults to QQUTILS_SQLITE_MEMORY_CACHE.
+    Values returned from the memory cache are shared and must not be mutated."""
+    _MEMORY_CACHE.clear()
+    _MEMORY_CACHE.maxsize = maxsize or 0
+
 
-    q_sql = 'select data from __cache__ where key = ?'
-    records = sqlite3_query(q_sql, (key,), db_path=db_path)
+def sqlite3_memory_cache_info() -> dict:
+    """Hit/miss/invalidation counters and size of the in-memory cache"""
+    return _MEMORY_CACHE.info()
 
-    if not records:
-        u_sql = 'INSERT INTO __cache__ (key, data) VALUES (?, ?)'
-        params = (key, json.dumps(data))
-        ret = None
+
+def sqlite3_set_negative_cache(fp_rate: Optional[float] = 0.01, *, db_path: str = None, rebuild_ratio: float = 0.25) -> None:
+    """Keep a Bloom filter of the keys of db_path (of every database without its own setting if
+    db_path is None), so that getting a missing key usually returns without a lookup.
+
+    The filter is built from a key scan on first use, sized for `fp_rate` at twice the current
+    number of keys, updated by puts and rebuilt once more than `rebuild_ratio` of its keys were
+    deleted or it is full. Keys inserted by other processes or unpooled connections are picked
+    up incrementally on the next get. None disables it.
+    """
+    if fp_rate is not None and not 0 < fp_rate < 1:
+        raise ValueError(f'fp_rate should be in (0, 1), got {fp_rate}')
+    with _NEGATIVE_CACHES_LOCK:
+        if fp_rate is not None:
+            _NEGATIVE_CACHE_SETTINGS[db_path] = (fp_rate, rebuild_ratio)
+        else:
+            _NEGATIVE_CACHE_SETTINGS.pop(db_path, None)
+        _NEGATIVE_CACHES.clear()    # filters may have missed writes while disabled, rebuild on next use
+
+
+def sqlite3_negative_cache_info(db_path: str = None) -> dict:
+    """Measured skip rate (lookups answered by the filter) and false positive rate (absent keys
+    the filter let through) of the negative cache of db_path, with its size"""
+    negative = _NEGATIVE_CACHES.get(db_path or _DEFAULT_DB_PATH)
+    return negative.info() if negative is not None else {}
+
+
+def sqlite3_set_compression(codec: Optional[str] = 'zlib', threshold: int = 4096, *, db_path: str = None) -> None:
+    """Compress data written by sqlite3_jput/sqlite3_jput_many to db_path (to every database
+    without its own setting if db_path is None) once its JSON is at least `threshold` bytes.
+    The codec is recorded per row, so reads decode transparently; None disables compression.
+    Compressed rows are stored in the payload column and are not visible to sqlite3_jquery."""
+    if codec is not None:
+        _codec(codec)   # validate
+    _COMPRESSION[db_path] = (codec, threshold)
+
+
+def sqlite3_register_codec(name: str, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]) -> None:
+    """Make a codec (e.g. 'lzma': (lzma.compress, lzma.decompress)) available to sqlite3_set_compression"""
+    _CODECS[name] = (compress, decompress)
+
+
+def sqlite3_set_serializer(serializer: Optional[str], *, db_path: str = None) -> None:
+    """Default serializer of sqlite3_jput/sqlite3_jput_many for db_path (for every database without its
+    own setting if db_path is None): 'json' (default), 'pickle' (protocol 5, only for trusted
+    databases), 'marshal' (simple built-in types) or a registered one. It is recorded per row,
+    so rows written with different serializers stay readable. Only JSON rows are visible to sqlite3_jquery."""
+    if serializer is not None:
+        _serializer(serializer)     # validate
+        _SERIALIZERS_BY_DB[db_path] = serializer
     else:
-        u_sql = 'UPDATE __cache__ SET data = ? WHERE key = ?'
-        params = (json.dumps(data), key)
-        # print(records)
-        ret = json.loads(records[-1]['data'])
-    logger.debug(f'[{db_path}] Executing [{u_sql}] with params {params}')
-    sqlite3_execute(u_sql, params, db_path=db_path)
-    return ret
+        _SERIALIZERS_BY_DB.pop(db_path, None)
 
 
-# SQLAlchemy
+def sqlite3_register_serializer(name: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]) -> None:
+    """Make a serializer available to sqlite3_jput and sqlite3_set_serializer"""
+    _SERIALIZERS[name] = (dumps, loads)
 
-def sqlalchemy_get_engine(db_path: str = None) -> Engine:
+
+def sqlite3_set_write_behind(interval: Optional[float] = 0.05, max_batch: int = 1000, *, db_path: str = None) -> None:
+    """Buffer put/jput/delete (and their batch variants) of db_path in memory and commit them
+    from a background thread every `interval` seconds or `max_batch` pending keys, whichever
+    comes first. Reads see pending writes; the durability window is bounded by `interval`.
+    Pending writes are flushed by sqlite3_flush, at exit, and when interval is None (disabled).
+    """
     db_path = db_path or _DEFAULT_DB_PATH
-    return create_engine(
-        f'sqlite:///{db_path}?check_same_thread=False',
-        echo=logger.isEnabledFor(logging.DEBUG)
+    with _WRITE_BEHIND_LOCK:
+        write_behind = _WRITE_BEHIND.get(db_path)
+        if write_behind is not None:
+            # flush while still registered: readers keep seeing the pending writes and
+            # writers wait for them to be committed before writing directly
+            write_behind.close()
+            del _WRITE_BEHIND[db_path]
+        if interval is not None:
+            _ensure_cache_table(db_path)
+            _WRITE_BEHIND[db_path] = _WriteBehind(db_path, interval, max_batch)
+
+
+def sqlite3_flush(db_path: str = None) -> int:
+    """Commit pending write-behind writes of db_path (of every database if None), return how many keys were written"""
+    if db_path is not None:
+        write_behind = _WRITE_BEHIND.get(db_path)
+        return write_behind.flush() if write_behind is not None else 0
+    return sum(write_behind.flush() for write_behind in list(_WRITE_BEHIND.values()))
+
+
+# JSON queries over __cache__.data
+
+_JSON_OPERATORS = {'=': '=', '==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=', 'like': 'LIKE', 'glob': 'GLOB'}
+
+
+def _json_expr(path: str, column: str = 'data') -> str:
+    """SQL for a JSON path of the data column, written inline so that expression indexes match it"""
+    if path == 'key':
+        return 'key'
+    if not path.startswith('$'):
+        raise ValueError(f"JSON path should start with '$', got {path!r}")
+    path = path.replace("'", "''")
+    return f"json_extract({column}, '{path}')"
+
+
+def _json_condition(path: str, cond: Any) -> Tuple[str, list]:
+    expr = _json_expr(path)
+    if cond is None:
+        return f'{expr} IS NULL', []
+    if isinstance(cond, (list, tuple, set)):
+        cond = list(cond)
+        return f'{expr} IN ({", ".join("?" * len(cond))})', cond
+    if isinstance(cond, dict):
+        sqls, params = [], []
+        for op, value in cond.items():
+            if op.lower() not in _JSON_OPERATORS:
+                raise ValueError(f'Unsupported operator {op!r}, expected one of {", ".join(_JSON_OPERATORS)}')
+            sqls.append(f'{expr} {_JSON_OPERATORS[op.lower()]} ?')
+            params.append(value)
+        return ' AND '.join(sqls), params
+    return f'{expr} = ?', [cond]
+
+
+def sqlite3_jquery(
+        where: Dict[str, Any] = None,
+        *,
+        order_by: Union[str, Iterable[str]] = None,
+        limit: int = None,
+        offset: int = None,
+        db_path: str = None,
+) -> List[Dict]:
+    """Search data stored with sqlite3_jput, filtering in SQL with json_extract.
+
+    `where` maps JSON paths (or 'key') to a value, None, a list of values (IN) or
+    a dict of operators such as {'>=': 1, '<': 10}; conditions are ANDed.
+    `order_by` is a JSON path or 'key', prefixed with '-' for descending order.
+    Create an index with sqlite3_jindex to avoid full scans.
+    Return [{'key': ..., 'data': ...}].
+    """
+    _ensure_cache_table(db_path)
+    _flush_pending(db_path)
+    sqls, params = ['data IS NOT NULL', _ALIVE], [time.time()]
+    for path, cond in (where or {}).items():
+        sql, p = _json_condition(path, cond)
+        sqls.append(sql)
+        params.extend(p)
+    sql = f'SELECT key, data FROM __cache__ WHERE {" AND ".join(sqls)}'
+    if order_by:
+        order_by = [order_by] if isinstance(order_by, str) else list(order_by)
+        sql += ' ORDER BY ' + ', '.join(_json_expr(o[1:]) + ' DESC' if o.startswith('-') else _json_expr(o) for o in order_by)
+    if limit is not None or offset is not None:
+        sql += ' LIMIT ? OFFSET ?'
+        params.extend([-1 if limit is None else limit, offset or 0])
+    return [{'key': row['key'], 'data': json.loads(row['data'])} for row in sqlite3_query(sql, params, db_path=db_path)]
+
+
+def sqlite3_jindex(path: str, *, db_path: str = None) -> str:
+    """Index a JSON path of data stored with sqlite3_jput so that sqlite3_jquery on it is O(log n),
+    return the index name"""
+    _ensure_cache_table(db_path)
+    # the digest keeps paths that sanitize alike ('$.a_b', '$.a.b') from sharing an index name
+    digest = hashlib.blake2b(path.encode(), digest_size=6).hexdigest()
+    name = '__cache_json_' + re.sub(r'\W', '_', path.lstrip('$.')) + f'_{digest}__'
+    sqlite3_execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON __cache__ ({_json_expr(path)})', db_path=db_path)
+    return name
+
+
+# Full-text search over __cache__
+
+def _fts_expr(source: str, row: str) -> str:
+    if source == 'value':
+        return f'{row}.value'
+    return f'CASE WHEN json_valid({row}.data) THEN {_json_expr(source, f"{row}.data")} END'
+
+
+def _fts_columns(sources: List[str]) -> str:
+    return ', '.join('"%s"' % s.replace('"', '""') for s in sources)
+
+
+def _fts_ddl(sources: List[str], tokenize: str) -> List[str]:
+    """The FTS table and its triggers, in the order sqlite3_fts_index reads them back from sqlite_master"""
+    columns = _fts_columns(sources)
+    new = ', '.join(_fts_expr(s, 'new') for s in sources)
+    tokenize = tokenize.replace("'", "''")
+    insert = f'INSERT INTO __cache_fts__ (rowid, key, {columns}) VALUES (new.rowid, new.key, {new});'
+    return [
+        f"CREATE VIRTUAL TABLE __cache_fts__ USING fts5(key UNINDEXED, {columns}, tokenize='{tokenize}')",
+        'CREATE TRIGGER __cache_fts_ad__ AFTER DELETE ON __cache__ BEGIN DELETE FROM __cache_fts__ WHERE rowid = old.rowid; END',
+        f'CREATE TRIGGER __cache_fts_ai__ AFTER INSERT ON __cache__ BEGIN {insert} END',
+        'CREATE TRIGGER __cache_fts_au__ AFTER UPDATE OF value, data ON __cache__ '
+        f'BEGIN DELETE FROM __cache_fts__ WHERE rowid = old.rowid; {insert} END',
+    ]
+
+
+def sqlite3_fts_index(
+        sources: Optional[Iterable[str]] = ('value',),
+        *,
+        db_path: str = None,
+        tokenize: str = 'unicode61 remove_diacritics 2',
+        rebuild: bool = False,
+) -> None:
+    """Keep an FTS5 index of __cache__ for sqlite3_search, in sync through triggers.
+
+    `sources` are 'value' (sqlite3_put) and/or JSON paths of data stored as JSON by
+    sqlite3_jput, e.g. ('$.title', '$.body'); compressed and non-JSON data is not indexed.
+    Calling it again with the same sources is a no-op, different ones rebuild the index
+    and None drops it. Rows are matched by rowid, which VACUUM may renumber, so pass
+    rebuild=True after a VACUUM.
+    """
+    _ensure_cache_table(db_path)
+    sources = list(dict.fromkeys(sources)) if sources is not None else []
+    ddl = _fts_ddl(sources, tokenize) if sources else []
+    existing = [
+        row['sql'] for row in sqlite3_query(
+            "SELECT sql FROM sqlite_master WHERE name IN ('__cache_fts__', '__cache_fts_ad__', '__cache_fts_ai__', '__cache_fts_au__') "
+            "ORDER BY type = 'trigger', name", db_path=db_path,
+        )
+    ]
+    if existing == ddl and not rebuild:
+        return
+    _flush_pending(db_path)
+    with _connection(db_path) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        for name in ('__cache_fts_ad__', '__cache_fts_ai__', '__cache_fts_au__'):
+            conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.execute('DROP TABLE IF EXISTS __cache_fts__')
+        for sql in ddl:
+            conn.execute(sql)
+        if sources:
+            exprs = ', '.join(_fts_expr(s, '__cache__') for s in sources)
+            conn.execute(f'INSERT INTO __cache_fts__ (rowid, key, {_fts_columns(sources)}) SELECT rowid, key, {exprs} FROM __cache__')
+        conn.commit()
+    logger.debug(f'[{db_path}] Indexed {sources} of __cache__ for full-text search')
+
+
+def sqlite3_search(
+        query: str,
+        limit: int = 10,
+        *,
+        highlight: Tuple[str, str] = None,
+        db_path: str = None,
+) -> List[Dict]:
+    """Full-text search over the sources indexed by sqlite3_fts_index, best matches first.
+
+    `query` uses the FTS5 syntax (``'sqlite AND "full text"'``, ``'title: sql*'``). Return
+    ``{'key', 'value', 'data', 'rank'}`` dicts (rank is bm25, lower is better), with
+    ``'highlights': {source: text}`` wrapping the matched terms in `highlight` = (open, close).
+    """
+    _flush_pending(db_path)
+    sources = [row['name'] for row in sqlite3_query("SELECT name FROM pragma_table_info('__cache_fts__')", db_path=db_path)][1:]
+    if not sources:
+        raise ValueError('No full-text index, create it with sqlite3_fts_index')
+    fields = ', '.join(f'c.{f}' for f in _CACHE_FIELDS['data'])
+    highlights, params = '', []
+    if highlight:
+        highlights = ''.join(f', highlight(__cache_fts__, {i + 1}, ?, ?) AS h{i}' for i in range(len(sources)))
+        params = list(highlight) * len(sources)
+    sql = (
+        f'SELECT c.key, c.value, {fields}, __cache_fts__.rank AS rank{highlights} '
+        f'FROM __cache_fts__ JOIN __cache__ c ON c.rowid = __cache_fts__.rowid AND c.key = __cache_fts__.key '
+        f'WHERE __cache_fts__ MATCH ? AND (c.expires_at IS NULL OR c.expires_at > ?) ORDER BY __cache_fts__.rank LIMIT ?'
     )
+    params += [query, time.time(), -1 if limit is None else limit]
+    records = []
+    for row in sqlite3_query(sql, params, db_path=db_path):
+        record = {
+            'key': row['key'],
+            'value': row['value'],
+            'data': _cache_decode('data', tuple(row[f] for f in _CACHE_FIELDS['data'])),
+            'rank': row['rank'],
+        }
+        if highlight:
+            record['highlights'] = {s: row[f'h{i}'] for i, s in enumerate(sources)}
+        records.append(record)
+    return records
+
+
+# Sharding
+
+class ShardedKV:
+    """The __cache__ KV API spread over `shards` SQLite files named ``{path_prefix}.{i}.db``.
+
+    Keys are routed by a stable hash (CRC32), so every process agrees on the
+    shard of a key and writes to different shards do not contend for the same
+    file lock. Batch and whole-store operations fan out to the shards in parallel.
+    """
+
+    def __init__(self, path_prefix: str, shards: int = 8):
+        if shards < 1:
+            raise ValueError(f'shards should be positive, got {shards}')
+        width = len(str(shards - 1))
+        self.paths = [f'{path_prefix}.{i:0{width}}.db' for i in range(shards)]
+        self._pool = create_thread_pool(shards, f'ShardedKV-{os.path.basename(path_prefix)}')
+
+    @property
+    def shards(self) -> int:
+        return len(self.paths)
+
+    def shard_of(self, key: str) -> str:
+        """db_path holding key"""
+        return self.paths[zlib.crc32(key.encode()) % len(self.paths)]
+
+    def _fan_out(self, func: Callable, *args, **kwargs) -> List[Any]:
+        """func(*args, db_path=path, **kwargs) on every shard in parallel, results in shard order"""
+        return list(self._pool.map(lambda path: func(*args, db_path=path, **kwargs), self.paths))
+
+    def _by_shard(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for k in keys:
+            groups.setdefault(self.shard_of(k), []).append(k)
+        return groups
+
+    def _get_many(self, func: Callable, keys: Iterable[str], **kwargs) -> List[Any]:
+        keys = list(keys)
+        groups = self._by_shard(dict.fromkeys(keys))
+        futures = {path: self._pool.submit(func, ks, db_path=path, **kwargs) for path, ks in groups.items()}
+        found = {}
+        for path, future in futures.items():
+            found.update(zip(groups[path], future.result()))
+        return [found[k] for k in keys]
 
+    def _put_many(self, func: Callable, mapping, **kwargs) -> List[Any]:
+        items = list(_items(mapping))
+        groups: Dict[str, List[Tuple[int, str, Any]]] = {}
+        for i, (k, v) in enumerate(items):
+            groups.setdefault(self.shard_of(k), []).append((i, k, v))
+        futures = [
+            (group, self._pool.submit(func, [(k, v) for _, k, v in group], db_path=path, **kwargs))
+            for path, group in groups.items()
+        ]
+        previous = [None] * len(items)
+        for group, future in futures:
+            for (i, _, _), p in zip(group, future.result()):
+                previous[i] = p
+        return previous
 
-def sqlalchemy_get_session(engine: Engine) -> Session:
-    return sessionmaker(bind=engine)()
+    def get(self, key: str, cast=str) -> Any:
+        return sqlite3_get(key, db_path=self.shard_of(key), cast=cast)
 
+    def put(self, key: str, value: Any, ttl: float = None) -> str:
+        return sqlite3_put(key, value, db_path=self.shard_of(key), ttl=ttl)
 
-def sqlalchemy_execute(sql: str, engine: Engine, params: dict = None) -> List[dict]:
+    def delete(self, key: str) -> None:
+        sqlite3_delete(key, db_path=self.shard_of(key))
+
+    def jget(self, key: str) -> Optional[dict]:
+        return sqlite3_jget(key, db_path=self.shard_of(key))
+
+    def jput(self, key: str, data: dict, ttl: float = None, serializer: str = None) -> Optional[dict]:
+        return sqlite3_jput(key, data, db_path=self.shard_of(key), ttl=ttl, serializer=serializer)
+
+    def get_many(self, keys: Iterable[str], cast=str) -> List[Any]:
+        return self._get_many(sqlite3_get_many, keys, cast=cast)
+
+    def put_many(self, mapping: Union[Mapping[str, Any], Iterable[Tuple[str, Any]]], ttl: float = None) -> List[str]:
+        return self._put_many(sqlite3_put_many, mapping, ttl=ttl)
+
+    def jget_many(self, keys: Iterable[str]) -> List[Optional[dict]]:
+        return self._get_many(sqlite3_jget_many, keys)
+
+    def jput_many(self, mapping: Union[Mapping[str, dict], Iterable[Tuple[str, dict]]], ttl: float = None, serializer: str = None) -> List[Optional[dict]]:
+        return self._put_many(sqlite3_jput_many, mapping, ttl=ttl, serializer=serializer)
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        groups = self._by_shard(keys)
+        return sum(self._pool.map(lambda path: sqlite3_delete_many(groups[path], db_path=path), groups))
+
+    def jget_all(self) -> List[Dict]:
+        return [row for rows in self._fan_out(sqlite3_jget_all) for row in rows]
+
+    def scan(
+            self,
+            prefix: str = None,
+            start: str = None,
+            end: str = None,
+            limit: int = None,
+            reverse: bool = False,
+            column: Optional[str] = None,
+    ) -> Iterator[Any]:
+        """sqlite3_scan over every shard, merged back into key order"""
+        streams = [
+            sqlite3_scan(prefix, start=start, end=end, limit=limit, reverse=reverse, column=column, db_path=path)
+            for path in self.paths
+        ]
+        merged = heapq.merge(*streams, key=(lambda kv: kv[0]) if column else None, reverse=reverse)
+        return itertools.islice(merged, limit)
+
+    def dump(self) -> None:
+        """sqlite3_dump of __cache__ for every shard, fetched in parallel and printed in shard order"""
+        def rows_of(db_path: str) -> list:
+            _ensure_cache_table(db_path)
+            return sqlite3_query('select * from "__cache__"', db_path=db_path)
+
+        for rows in self._fan_out(rows_of):
+            hprint([{'TABLE': '__cache__', **row} for row in rows])
+            print()
+
+    def purge(self, batch_size: int = 500, max_batches: int = None) -> int:
+        return sum(self._fan_out(sqlite3_purge, batch_size=batch_size, max_batches=max_batches))
+
+    def flush(self) -> int:
+        return sum(sqlite3_flush(path) for path in self.paths)
+
+    def close(self) -> None:
+        """Flush pending writes and close the pooled connections of every shard"""
+        self.flush()
+        self._pool.shutdown(wait=True)
+        for path in self.paths:
+            sqlite3_close_all(path)
+
+
+# Queue
+
+QueueItem = namedtuple('QueueItem', ['id', 'data', 'priority', 'attempts', 'receipt'])
+
+_QUEUE_TABLE_READY = set()     # db_paths whose __queue__ table is known to exist in this process
+
+
+def _ensure_queue_table(db_path: str) -> None:
+    if db_path in _QUEUE_TABLE_READY:
+        return
+    with _CACHE_TABLE_LOCK:
+        if db_path in _QUEUE_TABLE_READY:
+            return
+        sqlite3_execute(
+            'CREATE TABLE IF NOT EXISTS __queue__ ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, '
+            'data TEXT, created_at REAL NOT NULL, available_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, receipt TEXT)',
+            db_path=db_path,
+        )
+        sqlite3_execute('CREATE INDEX IF NOT EXISTS __queue_claim__ ON __queue__ (queue, priority DESC, id, available_at)', db_path=db_path)
+        _QUEUE_TABLE_READY.add(db_path)
+
+
+class SqliteQueue:
+    """Persistent work queue stored in the __queue__ table of db_path, shared by every
+    thread and process using the same `name`.
+
+    Items are JSON, served by priority (highest first) then insertion order. A claimed
+    item stays invisible for `visibility_timeout` seconds: ack() deletes it, nack()
+    makes it available again, and if neither happens in time it is delivered again
+    (with attempts incremented). Claims are a single ``UPDATE ... RETURNING`` in an
+    immediate transaction, so an item is never handed to two consumers at once; the
+    receipt of a claim keeps a consumer that timed out from acking a newer claim.
+    """
+
+    def __init__(self, name: str = 'default', *, db_path: str = None, visibility_timeout: float = 30.0, poll_interval: float = 0.1):
+        self.name = name
+        self.db_path = db_path or _DEFAULT_DB_PATH
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()      # wakes consumers of this instance on put
+        _ensure_queue_table(self.db_path)
+
+    def __len__(self):
+        return self.qsize()
+
+    def qsize(self) -> int:
+        """Number of items in the queue, claimed ones included"""
+        sql = 'SELECT count(*) AS n FROM __queue__ WHERE queue = ?'
+        return sqlite3_query(sql, (self.name,), db_path=self.db_path)[0]['n']
+
+    def put(self, data: Any, priority: int = 0, delay: float = 0) -> int:
+        """Enqueue data, available after `delay` seconds, return its id"""
+        return self.put_many([data], priority=priority, delay=delay)[0]
+
+    def put_many(self, items: Iterable[Any], priority: int = 0, delay: float = 0) -> List[int]:
+        """Enqueue items in a single transaction, return their ids"""
+        now = time.time()
+        params = [(self.name, priority, json.dumps(data), now, now + delay) for data in items]
+        sql = 'INSERT INTO __queue__ (queue, priority, data, created_at, available_at) VALUES (?, ?, ?, ?, ?) RETURNING id'
+        ids = []
+        with _connection(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for p in params:
+                ids.append(conn.execute(sql, p).fetchone()[0])
+            conn.commit()
+        with self._cond:
+            self._cond.notify(len(ids))
+        return ids
+
+    def _claim(self, n: int) -> List[QueueItem]:
+        now = time.time()
+        receipt = os.urandom(8).hex()
+        sql = (
+            'UPDATE __queue__ SET available_at = ?, attempts = attempts + 1, receipt = ? WHERE id IN ('
+            'SELECT id FROM __queue__ WHERE queue = ? AND available_at <= ? ORDER BY priority DESC, id LIMIT ?) '
+            'RETURNING id, data, priority, attempts'
+        )
+        with _connection(self.db_path) as conn:
+            # plain read first, so that polling an empty queue never takes the write lock
+            if conn.execute('SELECT 1 FROM __queue__ WHERE queue = ? AND available_at <= ? LIMIT 1', (self.name, now)).fetchone() is None:
+                return []
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(sql, (now + self.visibility_timeout, receipt, self.name, now, n)).fetchall()
+            conn.commit()
+        rows.sort(key=lambda r: (-r['priority'], r['id']))     # RETURNING order is unspecified
+        return [QueueItem(r['id'], json.loads(r['data']), r['priority'], r['attempts'], receipt) for r in rows]
+
+    def get_many(self, n: int, block: bool = True, timeout: float = None) -> List[QueueItem]:
+        """Claim up to n available items in one transaction. If none is available, wait
+        for one when block is true (at most `timeout` seconds if given), and raise
+        queue.Empty if there is still none."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            items = self._claim(n)
+            if items:
+                return items
+            remaining = deadline - time.monotonic() if deadline is not None else self.poll_interval
+            if not block or remaining <= 0:
+                raise queue.Empty
+            with self._cond:
+                self._cond.wait(min(remaining, self.poll_interval))     # polls for other processes' puts
+
+    def get(self, block: bool = True, timeout: float = None) -> QueueItem:
+        """Claim the next available item, see get_many"""
+        return self.get_many(1, block=block, timeout=timeout)[0]
+
+    def ack(self, *items: QueueItem) -> int:
+        """Delete processed items, return how many were still held by their claims"""
+        sql = 'DELETE FROM __queue__ WHERE id = ? AND receipt = ?'
+        with _connection(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            done = sum(conn.execute(sql, (item.id, item.receipt)).rowcount for item in items)
+            conn.commit()
+        return done
+
+    def nack(self, *items: QueueItem, delay: float = 0) -> int:
+        """Give items back to the queue, available again after `delay` seconds"""
+        sql = 'UPDATE __queue__ SET available_at = ?, receipt = NULL WHERE id = ? AND receipt = ?'
+        available_at = time.time() + delay
+        with _connection(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            done = sum(conn.execute(sql, (available_at, item.id, item.receipt)).rowcount for item in items)
+            conn.commit()
+        with self._cond:
+            self._cond.notify(done)
+        return done
+
+    def clear(self) -> int:
+        """Delete every item of the queue, return how many"""
+        with _connection(self.db_path) as conn:
+            n = conn.execute('DELETE FROM __queue__ WHERE queue = ?', (self.name,)).rowcount
+            conn.commit()
+        return n
+
+
+# asyncio
+
+_ASYNC_READERS = int(os.getenv('QQUTILS_SQLITE_ASYNC_READERS', 4))
+_ASYNC_EXECUTORS: Dict[str, Tuple[ThreadPoolExecutor, ThreadPoolExecutor]] = {}     # db_path -> (writer, readers)
+_ASYNC_LOCK = threading.Lock()
+
+
+def _async_executor(db_path: str, write: bool) -> ThreadPoolExecutor:
+    """One writer thread and a small reader pool per db_path, each thread keeps its pooled connection"""
+    db_path = db_path or _DEFAULT_DB_PATH
+    executors = _ASYNC_EXECUTORS.get(db_path)
+    if executors is None:
+        with _ASYNC_LOCK:
+            executors = _ASYNC_EXECUTORS.get(db_path)
+            if executors is None:
+                name = os.path.basename(db_path)
+                executors = _ASYNC_EXECUTORS[db_path] = (
+                    create_thread_pool(1, f'sqlite3-writer-{name}'),
+                    create_thread_pool(_ASYNC_READERS, f'sqlite3-reader-{name}'),
+                )
+    return executors[0 if write else 1]
+
+
+async def _run_async(write: bool, func: Callable, *args, db_path: str = None, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_async_executor(db_path, write), partial(func, *args, db_path=db_path, **kwargs))
+
+
+async def asqlite3_execute(sql: str, params: Iterable[Any] = None, *, db_path: str = None) -> None:
+    """sqlite3_execute on the writer thread of db_path"""
+    return await _run_async(True, sqlite3_execute, sql, params, db_path=db_path)
+
+
+async def asqlite3_query(sql: str, params: Iterable[Any] = None, *, db_path: str = None) -> list:
+    """sqlite3_query on the reader pool of db_path"""
+    return await _run_async(False, sqlite3_query, sql, params, db_path=db_path)
+
+
+async def asqlite3_get(key: str, *, db_path: str = None, cast=str) -> Any:
+    return await _run_async(False, sqlite3_get, key, db_path=db_path, cast=cast)
+
+
+async def asqlite3_put(key: str, value: Any, *, db_path: str = None, ttl: float = None) -> str:
+    return await _run_async(True, sqlite3_put, key, value, db_path=db_path, ttl=ttl)
+
+
+async def asqlite3_delete(key: str, *, db_path: str = None) -> None:
+    return await _run_async(True, sqlite3_delete, key, db_path=db_path)
+
+
+async def asqlite3_jget(key: str, *, db_path: str = None) -> Optional[dict]:
+    return await _run_async(False, sqlite3_jget, key, db_path=db_path)
+
+
+async def asqlite3_jput(key: str, data: dict, *, db_path: str = None, ttl: float = None, serializer: str = None) -> Optional[dict]:
+    return await _run_async(True, sqlite3_jput, key, data, db_path=db_path, ttl=ttl, serializer=serializer)
+
+
+async def asqlite3_get_many(keys: Iterable[str], *, db_path: str = None, cast=str) -> List[Any]:
+    return await _run_async(False, sqlite3_get_many, list(keys), db_path=db_path, cast=cast)
+
+
+async def asqlite3_put_many(mapping: Union[Mapping[str, Any], Iterable[Tuple[str, Any]]], *, db_path: str = None, ttl: float = None) -> List[str]:
+    return await _run_async(True, sqlite3_put_many, list(_items(mapping)), db_path=db_path, ttl=ttl)
+
+
+async def asqlite3_jget_many(keys: Iterable[str], *, db_path: str = None) -> List[Optional[dict]]:
+    return await _run_async(False, sqlite3_jget_many, list(keys), db_path=db_path)
+
+
+async def asqlite3_jput_many(
+        mapping: Union[Mapping[str, dict], Iterable[Tuple[str, dict]]],
+        *,
+        db_path: str = None,
+        ttl: float = None,
+        serializer: str = None,
+) -> List[Optional[dict]]:
+    return await _run_async(True, sqlite3_jput_many, list(_items(mapping)), db_path=db_path, ttl=ttl, serializer=serializer)
+
+
+async def asqlite3_delete_many(keys: Iterable[str], *, db_path: str = None) -> int:
+    return await _run_async(True, sqlite3_delete_many, list(keys), db_path=db_path)
+
+
+async def asqlite3_jquery(where: Dict[str, Any] = None, **kwargs) -> List[Dict]:
+    """sqlite3_jquery on the reader pool, see its keyword arguments"""
+    return await _run_async(False, sqlite3_jquery, where, **kwargs)
+
+
+async def asqlite3_search(query: str, limit: int = 10, **kwargs) -> List[Dict]:
+    """sqlite3_search on the reader pool, see its keyword arguments"""
+    return await _run_async(False, sqlite3_search, query, limit, **kwargs)
+
+
+# SQLAlchemy
+
+_ENGINES: Dict[tuple, 'Engine'] = {}                # (db_path, options) -> Engine
+_SESSION_FACTORY: Optional['sessionmaker'] = None  # unbound, engines are passed per session so none is kept alive
+_ENGINES_LOCK = threading.Lock()
+
+
+def sqlalchemy_get_engine(db_path: str = None, **options) -> 'Engine':
+    """Return the cached Engine for (db_path, options), creating it on first use.
+    `options` are passed to sqlalchemy.create_engine (pool_size, max_overflow, pool_recycle, ...)"""
+    db_path = db_path or _DEFAULT_DB_PATH
+    key = (db_path, tuple(sorted((k, repr(v)) for k, v in options.items())))
+    engine = _ENGINES.get(key)
+    if engine is not None:
+        return engine
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            from sqlalchemy import create_engine
+            options.setdefault('echo', logger.isEnabledFor(logging.DEBUG))
+            engine = _ENGINES[key] = create_engine(f'sqlite:///{db_path}?check_same_thread=False', **options)
+    return engine
+
+
+def sqlalchemy_dispose_all() -> int:
+    """Dispose the connection pools of all cached engines and forget them, return how many there were"""
+    with _ENGINES_LOCK:
+        engines = list(_ENGINES.values())
+        _ENGINES.clear()
+    for engine in engines:
+        engine.dispose()
+    return len(engines)
+
+
+def sqlalchemy_get_session(engine: 'Engine') -> 'Session':
+    """Return a new Session bound to engine, the caller is responsible for closing it"""
+    global _SESSION_FACTORY
+    if _SESSION_FACTORY is None:
+        from sqlalchemy.orm import sessionmaker
+        _SESSION_FACTORY = sessionmaker()
+    return _SESSION_FACTORY(bind=engine)
+
+
+def sqlalchemy_execute(sql: str, engine: 'Engine', params: dict = None) -> List['Row']:
+    """Execute sql in its own session and transaction (committed on success), return all rows"""
+    from sqlalchemy import text
     logger.debug(f'[{engine.url}] Executing [{sql}] with params {params}')
-    session = sqlalchemy_get_session(engine)
-    sql = text(sql)
-    if params:
-        rows = session.execute(sql, params).fetchall()
-    else:
-        rows = session.execute(sql).fetchall()
-    return rows
+    with sqlalchemy_get_session(engine) as session, session.begin():
+        result = session.execute(text(sql), params or {})
+        return result.fetchall() if result.returns_rows else []
+
+
+def sqlalchemy_iter_execute(sql: str, engine: 'Engine', params: dict = None, *, yield_per: int = 1000) -> Iterator['Row']:
+    """Lazily yield the rows of sql using a server-side cursor (stream_results/yield_per),
+    the session is closed once the generator is exhausted, closed or garbage collected"""
+    from sqlalchemy import text
+    logger.debug(f'[{engine.url}] Iterating [{sql}] with params {params}')
+    with sqlalchemy_get_session(engine) as session, session.begin():
+        result = session.execute(
+            text(sql), params or {},
+            execution_options={'stream_results': True, 'yield_per': yield_per},
+        )
+        yield from result
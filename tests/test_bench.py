@@ -0,0 +1,23 @@
+from qqutils.bench import measure_import, check_budgets, _parse_importtime
+
+
+def test_parse_importtime():
+    stderr = (
+        'import time: self [us] | cumulative | imported package\n'
+        'import time:       120 |        120 |   _io\n'
+        'import time:      2000 |       5000 | qqutils.dsutils\n'
+    )
+    records = _parse_importtime(stderr)
+    assert [r['module'] for r in records] == ['_io', 'qqutils.dsutils']
+    assert records[1]['cumulative_us'] == 5000
+    assert records[0]['depth'] == 1 and records[1]['depth'] == 0
+
+
+def test_measure_import():
+    result = measure_import('qqutils.dsutils', repeat=1)
+    assert result['import_ms'] > 0
+    assert result['rss'] > 0
+    assert any(r['module'] == 'qqutils.dsutils' for r in result['importtime'])
+    assert not any(r['module'] in ('site', 'encodings') for r in result['importtime'])   # interpreter startup
+    assert check_budgets([result], {'qqutils.dsutils': 0.0})
+    assert not check_budgets([result], {}, default_budget=None)
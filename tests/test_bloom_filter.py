@@ -0,0 +1,137 @@
+import pytest
+from qqutils.bloom_filter import PyBitArray, NumpyBitArray
+
+
+@pytest.mark.parametrize('cls', [PyBitArray, NumpyBitArray])
+def test_bitarray(cls):
+    bits = cls.from_iterable([1, 1, 0, 1, 1, 1, 0, 1, 1])
+    assert len(bits) == 9 and list(bits) == [1, 1, 0, 1, 1, 1, 0, 1, 1] and bits.count() == 7
+
+    zeros = cls.zeros(20)
+    zeros.set_many([0, 3, 19])
+    zeros[5] = 1
+    zeros[3] = 0
+    assert [i for i, b in enumerate(zeros) if b] == [0, 5, 19]
+    assert list(zeros.test_many(iter([0, 3, 5, 19]))) == [True, False, True, True]
+    with pytest.raises(IndexError):
+        zeros.set_many([20])
+    with pytest.raises(IndexError):
+        zeros[-1]
+
+    a, b = cls.zeros(16), cls.zeros(16)
+    a.set_many([1, 2])
+    b.set_many([2, 3])
+    assert list(a | b)[:5] == [0, 1, 1, 1, 0]
+    assert (a & b).count() == 1 and (a ^ b).count() == 2
+    with pytest.raises(ValueError):
+        a | cls.zeros(8)
+
+
+def test_numpy_bitarray_matches_fallback():
+    import random
+    bits = [random.random() < 0.3 for _ in range(100_003)]
+    fast, slow = NumpyBitArray.from_iterable(bits), PyBitArray.from_iterable(bits)
+    assert bytes(fast.data) == bytes(slow.data) and list(fast) == list(slow) and fast.count() == slow.count()
+
+
+@pytest.mark.parametrize('mem', [lambda n: PyBitArray.zeros(n), lambda n: NumpyBitArray.zeros(n), lambda n: [0] * n])
+def test_bloom_filter_batch(mem):
+    import hashlib
+    from qqutils.bloom_filter import BloomFilter, split_long_hash
+
+    def long_hash(s: str) -> int:
+        return int.from_bytes(hashlib.sha256(s.encode()).digest(), byteorder='big')
+
+    calc_hashes = split_long_hash(long_hash, digest_size=32, hashes=5, bytes_per_hash=6)
+    bloom, single = BloomFilter(mem=mem(20_000), calc_hashes=calc_hashes), BloomFilter(mem=mem(20_000), calc_hashes=calc_hashes)
+    present = [f'key-{i}' for i in range(1000)]
+    bloom.add_many(iter(present))
+    for s in present:
+        single.add(s)
+    assert list(bloom.mem) == list(single.mem)
+
+    absent = [f'other-{i}' for i in range(1000)]
+    hits = bloom.contains_many(present + absent)
+    assert len(hits) == 2000 and all(hits[:1000])
+    assert list(hits[1000:]) == [s in bloom for s in absent] and sum(hits[1000:]) < 50
+    assert len(bloom.contains_many([])) == 0
+
+
+def test_double_hashing():
+    import numpy as np
+    from qqutils.bloom_filter import BloomFilter, DoubleHashing, BitArray
+
+    hashes = DoubleHashing(7)
+    items = ['a', b'a', 42, 'x' * 100]
+    assert hashes('a') == hashes(b'a') and len(set(hashes('x'))) == 7
+    assert hashes.many(items).tolist() == [hashes(i) for i in items]
+    with pytest.raises(ValueError):
+        DoubleHashing(3, digest='md5')
+
+    n, m = 20_000, 200_000
+    bloom = BloomFilter(mem=BitArray.zeros(m), calc_hashes=hashes)
+    bloom.add_many(f'in-{i}' for i in range(n))
+    assert bloom.contains_many(f'in-{i}' for i in range(n)).all()
+    assert [f'in-{i}' in bloom for i in range(10)] == [True] * 10
+    fp = float(np.mean(bloom.contains_many(f'out-{i}' for i in range(100_000))))
+    estimate = BloomFilter.estimate_false_positive_rate(7, m, n)
+    assert abs(fp - estimate) < estimate * 0.3
+
+
+def test_for_capacity_and_scalable():
+    import numpy as np
+    from qqutils.bloom_filter import BloomFilter, ScalableBloomFilter
+
+    assert BloomFilter.optimal_size(1000, 0.01) == (9586, 7)
+    bloom = BloomFilter.for_capacity(10_000, 0.01)
+    bloom.add_many(f'in-{i}' for i in range(10_000))
+    assert 0.45 < bloom.fill_ratio < 0.55 and abs(bloom.estimated_count - 10_000) < 300
+    assert float(np.mean(bloom.contains_many(f'out-{i}' for i in range(50_000)))) < 0.015
+
+    sbf = ScalableBloomFilter(initial_capacity=1000, fp_rate=0.01)
+    sbf.add_many(f'in-{i}' for i in range(20_000))
+    sbf.add_many(f'in-{i}' for i in range(100))     # already present
+    sbf.add('extra')
+    assert len(sbf.slices) == 5 and 20_000 <= len(sbf) <= 20_001
+    assert abs(sbf.estimated_count - 20_000) < 600 and 0 < sbf.fill_ratio < 0.6
+    assert sbf.contains_many(f'in-{i}' for i in range(20_000)).all() and 'extra' in sbf
+    assert float(np.mean(sbf.contains_many(f'out-{i}' for i in range(50_000)))) < 0.01
+
+
+@pytest.mark.parametrize('cls', [PyBitArray, NumpyBitArray])
+@pytest.mark.parametrize('mmap', [True, False])
+@pytest.mark.parametrize('mode', ['r', 'r+'])
+def test_save_load(tmp_path, cls, mmap, mode):
+    from qqutils.bloom_filter import BloomFilter, DoubleHashing
+
+    path = str(tmp_path / 'bits')
+    bits = cls.from_iterable([1, 0, 0, 1, 1, 0, 1, 0, 1, 1, 1])
+    bits.save(path)
+    loaded = cls.load(path, mmap=mmap, mode=mode)
+    assert list(loaded) == list(bits) and loaded.count() == 7
+    if mmap and mode == 'r+':
+        loaded[1] = 1
+        del loaded
+        assert cls.load(path).count() == 8      # written through to the file
+
+    bloom = BloomFilter(mem=cls.zeros(10_000), calc_hashes=DoubleHashing(5))
+    bloom.add_many(f'in-{i}' for i in range(500))
+    bloom.save(path)
+    loaded = BloomFilter.load(path, mmap=mmap, mode=mode)
+    assert (loaded.n_items, loaded.n_hashes, len(loaded.mem)) == (500, 5, 10_000)
+    assert all(loaded.contains_many(f'in-{i}' for i in range(500)))
+    assert list(loaded.contains_many(f'out-{i}' for i in range(500))) == list(bloom.contains_many(f'out-{i}' for i in range(500)))
+    if mmap and mode == 'r+':
+        loaded.add('x')
+        assert 'x' in loaded
+    elif mmap:
+        with pytest.raises((TypeError, ValueError)):    # read-only mapping
+            loaded.add('x')
+        writable = BloomFilter.load(path, mode='c')
+        writable.add('x')
+        assert 'x' in writable and BloomFilter.load(path).n_items == 500
+
+    with open(path, 'wb') as f:
+        f.write(b'garbage')
+    with pytest.raises(ValueError):
+        cls.load(path)
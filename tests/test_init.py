@@ -0,0 +1,29 @@
+import sys
+import json
+import importlib
+import subprocess
+import qqutils
+
+
+def test_exports_table_in_sync():
+    for module_name, names in qqutils._EXPORTS.items():
+        module = importlib.import_module(module_name, 'qqutils')
+        if module_name.startswith('.'):
+            assert tuple(module.__all__) == names, module_name
+        for name in names:
+            assert getattr(qqutils, name) is getattr(module, name)
+
+
+def test_dir():
+    names = dir(qqutils)
+    for name in qqutils.__all__:
+        assert name in names
+    for name in qqutils._SUBMODULES:
+        assert name in names
+    assert qqutils.dsutils is importlib.import_module('qqutils.dsutils')
+
+
+def test_lazy_import():
+    code = 'import sys, json; from qqutils import pget; print(json.dumps(sorted(m for m in sys.modules if m.startswith("qqutils"))))'
+    out = subprocess.check_output([sys.executable, '-c', code], text=True)
+    assert json.loads(out) == ['qqutils', 'qqutils.dsutils']
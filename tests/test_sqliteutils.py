@@ -1,3 +1,5 @@
+import time
+import json
 from qqutils.sqliteutils import (
     sqlalchemy_execute,
     sqlalchemy_get_engine,
@@ -86,3 +88,718 @@ def test_sqlalchemy():
 
     output = sqlalchemy_execute('select * from users', engine)
     print(output)
+
+
+def test_sqlite3_connection_cache(tmp_path):
+    import threading
+    from qqutils.sqliteutils import _POOL, sqlite3_close_all, sqlite3_set_max_idle
+
+    db_path = str(tmp_path / 'pool.db')
+    sqlite3_put('k', 'v', db_path=db_path)
+    conn = _POOL.acquire(db_path)
+    assert sqlite3_get('k', db_path=db_path) == 'v'
+    assert _POOL.acquire(db_path) is conn
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(_POOL.acquire(db_path)))
+    t.start()
+    t.join()
+    assert other[0] is not conn
+
+    assert sqlite3_close_all(db_path) == 2
+    assert _POOL.acquire(db_path) is not conn
+    assert sqlite3_get('k', db_path=db_path) == 'v'
+
+    sqlite3_set_max_idle(0)
+    try:
+        conn = _POOL.acquire(db_path)
+        time.sleep(0.01)
+        assert _POOL.acquire(db_path) is not conn
+    finally:
+        sqlite3_set_max_idle(None)
+        sqlite3_close_all(db_path)
+
+
+def test_sqlite3_put_atomic(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    db_path = str(tmp_path / 'upsert.db')
+    with ThreadPoolExecutor(8) as pool:
+        previous = list(pool.map(lambda i: sqlite3_put('k', str(i), db_path=db_path), range(200)))
+    # every write observed exactly one predecessor: no update was lost
+    assert previous.count(None) == 1
+    assert len(set(previous)) == 200
+    assert set(previous) - {None} | {sqlite3_get('k', db_path=db_path)} == {str(i) for i in range(200)}
+
+
+def test_sqlite3_batch(tmp_path):
+    from qqutils.sqliteutils import (
+        sqlite3_get_many, sqlite3_put_many, sqlite3_jget_many, sqlite3_jput_many, sqlite3_delete_many,
+    )
+
+    db_path = str(tmp_path / 'batch.db')
+    keys = [f'k{i}' for i in range(1200)]
+    assert sqlite3_put_many({k: k.upper() for k in keys}, db_path=db_path) == [None] * len(keys)
+    assert sqlite3_put_many([('k1', 'a'), ('x', 'b'), ('k1', 'c')], db_path=db_path) == ['K1', None, 'a']
+    assert sqlite3_get_many(['x', 'missing', 'k1', 'k1199'], db_path=db_path) == ['b', None, 'c', 'K1199']
+    assert sqlite3_get_many(keys, db_path=db_path)[2:] == [k.upper() for k in keys[2:]]
+
+    assert sqlite3_jput_many({'j1': {'a': 1}, 'j2': [1, 2]}, db_path=db_path) == [None, None]
+    assert sqlite3_jput_many({'j2': {'b': 2}}, db_path=db_path) == [[1, 2]]
+    assert sqlite3_jget_many(['j2', 'j3', 'j1'], db_path=db_path) == [{'b': 2}, None, {'a': 1}]
+
+    assert sqlite3_delete_many(keys + ['nope'], db_path=db_path) == len(keys)
+    assert sqlite3_get_many(['k0', 'x'], db_path=db_path) == [None, 'b']
+
+
+def test_sqlite3_iter_query(tmp_path):
+    import gc
+    import pytest
+    from qqutils.sqliteutils import sqlite3_put_many, sqlite3_iter_query, sqlite3_iter_table, sqlite3_jget_all
+
+    db_path = str(tmp_path / 'iter.db')
+    sqlite3_put_many({f'k{i:03}': str(i) for i in range(250)}, db_path=db_path)
+
+    rows = sqlite3_iter_query('select key, value from __cache__ where key < ? order by key', ('k010',), db_path=db_path, batch_size=3)
+    assert next(rows) == {'key': 'k000', 'value': '0'}
+    assert len(list(rows)) == 9
+
+    rows = list(sqlite3_iter_table('__cache__', db_path=db_path, batch_size=7, row_type='tuple'))
+    assert len(rows) == 250 and rows[0][:3] == ('k000', '0', None)
+
+    row = next(sqlite3_iter_query('select key, value from __cache__', db_path=db_path, row_type='namedtuple'))
+    assert row.key == 'k000' and row.value == '0'
+    gc.collect()
+
+    assert len(sqlite3_jget_all(db_path=db_path)) == 250
+    with pytest.raises(ValueError):
+        next(sqlite3_iter_table('__cache__', db_path=db_path, row_type='list'))
+
+
+def test_sqlite3_profile(tmp_path, monkeypatch):
+    import sqlite3
+    import pytest
+    from contextlib import closing
+    from qqutils.sqliteutils import sqlite3_connect, sqlite3_set_profile, sqlite3_close_all, _connection
+
+    db_path = str(tmp_path / 'profile.db')
+    with closing(sqlite3_connect(db_path, profile='fast')) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+    monkeypatch.setenv('QQUTILS_SQLITE_PROFILE', 'durable')
+    try:
+        sqlite3_put('k', 'v', db_path=db_path)
+        with _connection(db_path) as conn:
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 2
+            assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 10_000
+
+        sqlite3_set_profile('readonly', db_path=db_path)
+        assert sqlite3_get('k', db_path=db_path) == 'v'
+        with pytest.raises(sqlite3.OperationalError):
+            sqlite3_put('k', 'w', db_path=db_path)
+        sqlite3_set_profile(None, db_path=db_path)
+        assert sqlite3_put('k', 'w', db_path=db_path) == 'v'
+
+        with pytest.raises(ValueError):
+            sqlite3_set_profile('turbo')
+    finally:
+        sqlite3_set_profile(None, db_path=db_path)
+        sqlite3_close_all(db_path)
+
+
+def test_sqlite3_ttl_and_eviction(tmp_path):
+    import qqutils.sqliteutils as sqliteutils
+    from qqutils.sqliteutils import (
+        sqlite3_put_many, sqlite3_jget_all, sqlite3_set_cache_policy, sqlite3_purge, sqlite3_query, sqlite3_execute,
+    )
+
+    db_path = str(tmp_path / 'ttl.db')
+    assert sqlite3_put('k', 'v', db_path=db_path, ttl=-1) is None
+    assert sqlite3_get('k', db_path=db_path) is None
+    assert sqlite3_jput('k', {'a': 1}, db_path=db_path, ttl=60) is None
+    assert sqlite3_get('k', db_path=db_path) is None      # value of the expired row is gone
+    assert sqlite3_jget('k', db_path=db_path) == {'a': 1}
+
+    sqlite3_put_many({f'x{i}': str(i) for i in range(10)}, db_path=db_path, ttl=-1)
+    assert len(sqlite3_jget_all(db_path=db_path)) == 1
+    assert sqlite3_purge(db_path=db_path, batch_size=3) == 10
+
+    sqlite3_set_cache_policy(max_entries=5, db_path=db_path, purge_every=1, batch_size=2)
+    try:
+        for i in range(5):
+            sqlite3_put(f'lru{i}', str(i), db_path=db_path)
+        sqlite3_query('select 1', db_path=db_path)
+        sqlite3_execute('UPDATE __cache__ SET atime = 0 WHERE key = ?', ('k',), db_path=db_path)
+        sqlite3_purge(db_path=db_path)
+        keys = {row['key'] for row in sqlite3_query('select key from __cache__', db_path=db_path)}
+        assert len(keys) == 5 and 'k' not in keys
+        sqlite3_set_cache_policy(db_path=db_path)
+        while sqliteutils._AUTO_PURGES:     # background purges would apply the next policy
+            time.sleep(0.01)
+
+        sqlite3_set_cache_policy(max_bytes=2000, db_path=db_path, purge_every=10**9)
+        sqlite3_put_many({f'b{i:03}': 'x' * 96 for i in range(100)}, db_path=db_path)    # 100 bytes per row
+        assert sqlite3_purge(db_path=db_path, batch_size=7) > 70
+        size = sqlite3_query('select sum(length(key) + length(value)) as n from __cache__', db_path=db_path)[0]['n']
+        assert 2000 - 7 * 100 < size <= 2000
+        sqlite3_put_many({f'u{i:03}': 'é' * 48 for i in range(100)}, db_path=db_path)    # 100 bytes, 52 characters per row
+        sqlite3_purge(db_path=db_path, batch_size=7)
+        size = sqlite3_query('select sum(length(CAST(key AS BLOB)) + length(CAST(value AS BLOB))) as n from __cache__', db_path=db_path)[0]['n']
+        assert size <= 2000
+
+        sqlite3_set_cache_policy(max_entries=1000, db_path=db_path)     # default purge_every and batch_size
+        for n in range(10):
+            sqlite3_put_many({f'd{n}-{i}': 'x' for i in range(1000)}, db_path=db_path)
+        deadline = time.time() + 10
+        while sqlite3_query('select count(*) as n from __cache__', db_path=db_path)[0]['n'] > 1000 and time.time() < deadline:
+            time.sleep(0.05)
+        assert sqlite3_query('select count(*) as n from __cache__', db_path=db_path)[0]['n'] == 1000
+    finally:
+        sqlite3_set_cache_policy(db_path=db_path)
+
+
+def test_sqlite3_memory_cache(tmp_path, monkeypatch):
+    import sqlite3
+    import threading
+    from contextlib import closing
+    import qqutils.sqliteutils as sqliteutils
+    from qqutils.sqliteutils import (
+        sqlite3_set_memory_cache, sqlite3_memory_cache_info, sqlite3_set_cache_policy, sqlite3_purge, sqlite3_query,
+        sqlite3_set_write_behind, sqlite3_get_many,
+    )
+
+    db_path = str(tmp_path / 'memory.db')
+    lru_path = str(tmp_path / 'memory_lru.db')
+    sqlite3_set_memory_cache(2)
+    try:
+        sqlite3_jput('a', {'n': 1}, db_path=db_path)
+        hits = sqlite3_memory_cache_info()['hits']
+        assert sqlite3_jget('a', db_path=db_path) == {'n': 1}
+        assert sqlite3_jget('a', db_path=db_path) == {'n': 1}
+        assert sqlite3_memory_cache_info()['hits'] == hits + 1
+
+        sqlite3_jput('a', {'n': 2}, db_path=db_path)    # local write
+        assert sqlite3_jget('a', db_path=db_path) == {'n': 2}
+
+        with closing(sqlite3.connect(db_path)) as conn:  # write from "another process"
+            conn.execute('UPDATE __cache__ SET data = ? WHERE key = ?', ('{"n": 3}', 'a'))
+            conn.commit()
+        assert sqlite3_jget('a', db_path=db_path) == {'n': 3}
+
+        sqlite3_delete('a', db_path=db_path)
+        assert sqlite3_jget('a', db_path=db_path) is None
+
+        for k in 'bcd':
+            sqlite3_put(k, k, db_path=db_path)
+            sqlite3_get(k, db_path=db_path)
+        assert sqlite3_memory_cache_info()['size'] == 2
+
+        assert sqlite3_get('d', db_path=db_path) == 'd'
+        with closing(sqlite3.connect(db_path)) as conn:
+            conn.execute("UPDATE __cache__ SET value = 'D' WHERE key = 'd'")
+            conn.commit()
+        thread = threading.Thread(target=sqlite3_put, args=('e', 'e'), kwargs={'db_path': db_path})
+        thread.start()
+        thread.join()
+        assert sqlite3_get('d', db_path=db_path) == 'D'    # the local commit does not hide the foreign one
+
+        sqlite3_set_write_behind(60, db_path=db_path)
+        try:
+            sqlite3_put('wb', 'w', db_path=db_path)
+            hits = sqlite3_memory_cache_info()['hits']
+            assert sqlite3_get_many(['wb', 'd'], db_path=db_path) == ['w', 'D']
+            assert sqlite3_memory_cache_info()['hits'] == hits + 1     # 'wb' came from the write-behind buffer
+        finally:
+            sqlite3_set_write_behind(None, db_path=db_path)
+
+        monkeypatch.setattr(sqliteutils, '_ATIME_RESOLUTION', 0)
+        sqlite3_set_cache_policy(max_entries=3, db_path=lru_path, purge_every=10**9)
+        sqlite3_put('hot', 'h', db_path=lru_path)
+        assert sqlite3_get('hot', db_path=lru_path) == 'h'
+        for i in range(3):
+            time.sleep(0.01)
+            sqlite3_put(f'cold{i}', 'c', db_path=lru_path)
+        hits = sqlite3_memory_cache_info()['hits']
+        time.sleep(0.01)
+        assert sqlite3_get('hot', db_path=lru_path) == 'h'
+        assert sqlite3_memory_cache_info()['hits'] == hits + 1
+        assert sqlite3_purge(db_path=lru_path) == 1
+        assert sorted(r['key'] for r in sqlite3_query('select key from __cache__', db_path=lru_path)) == ['cold1', 'cold2', 'hot']
+    finally:
+        sqlite3_set_cache_policy(db_path=lru_path)
+        sqlite3_set_memory_cache(0)
+
+
+def test_sqlite3_jquery(tmp_path):
+    from qqutils.sqliteutils import sqlite3_jput_many, sqlite3_jquery, sqlite3_jindex, sqlite3_query
+
+    db_path = str(tmp_path / 'jquery.db')
+    sqlite3_jput_many({f'u{i}': {'user': {'id': i % 5, 'name': f'n{i}'}, 'score': i} for i in range(20)}, db_path=db_path)
+    sqlite3_put('plain', 'value', db_path=db_path)
+
+    rows = sqlite3_jquery({'$.user.id': 3}, order_by='-$.score', db_path=db_path)
+    assert [r['key'] for r in rows] == ['u18', 'u13', 'u8', 'u3']
+    assert rows[0]['data']['user'] == {'id': 3, 'name': 'n18'}
+
+    rows = sqlite3_jquery({'$.user.id': [1, 2], '$.score': {'>=': 10}}, order_by='$.score', limit=2, db_path=db_path)
+    assert [r['key'] for r in rows] == ['u11', 'u12']
+    assert len(sqlite3_jquery(db_path=db_path)) == 20
+
+    name = sqlite3_jindex('$.user.id', db_path=db_path)
+    plan = sqlite3_query("EXPLAIN QUERY PLAN SELECT key FROM __cache__ WHERE json_extract(data, '$.user.id') = 3", db_path=db_path)
+    assert any(name in row['detail'] for row in plan)
+    assert sqlite3_jindex('$.user.id', db_path=db_path) == name
+    other = sqlite3_jindex('$.user_id', db_path=db_path)
+    assert other != name and "'$.user_id'" in sqlite3_query('select sql from sqlite_master where name = ?', (other,), db_path=db_path)[0]['sql']
+
+
+def test_sqlalchemy_engine_cache(tmp_path):
+    import gc
+    import weakref
+    from sqlalchemy import create_engine
+    from qqutils.sqliteutils import sqlalchemy_dispose_all, sqlalchemy_iter_execute
+
+    db_path = str(tmp_path / 'engine.db')
+    engine = sqlalchemy_get_engine(db_path)
+    assert sqlalchemy_get_engine(db_path) is engine
+    assert sqlalchemy_get_engine(db_path, pool_pre_ping=True) is not engine
+
+    sqlalchemy_execute('create table t (n integer)', engine)
+    for n in range(10):
+        sqlalchemy_execute('insert into t values (:n)', engine, {'n': n})
+    assert [r.n for r in sqlalchemy_execute('select n from t where n < :n', engine, {'n': 3})] == [0, 1, 2]
+    rows = sqlalchemy_iter_execute('select n from t order by n', engine, yield_per=3)
+    assert sum(r.n for r in rows) == 45
+    assert sqlalchemy_dispose_all() >= 2
+    assert sqlalchemy_get_engine(db_path) is not engine
+
+    outside = create_engine(f'sqlite:///{db_path}')     # not cached by sqlalchemy_get_engine
+    assert sqlalchemy_execute('select count(*) as n from t', outside)[0].n == 10
+    outside.dispose()
+    ref = weakref.ref(outside)
+    del outside
+    gc.collect()
+    assert ref() is None
+
+
+def test_asqlite3(tmp_path):
+    import asyncio
+    from qqutils.sqliteutils import asqlite3_put, asqlite3_get, asqlite3_jput, asqlite3_jget, asqlite3_put_many, asqlite3_query
+
+    db_path = str(tmp_path / 'async.db')
+
+    async def main():
+        assert await asqlite3_put('k', 'v', db_path=db_path) is None
+        previous = await asyncio.gather(*(asqlite3_put('n', str(i), db_path=db_path) for i in range(50)))
+        assert len(set(previous)) == 50
+        assert await asqlite3_get('k', db_path=db_path) == 'v'
+        await asqlite3_jput('j', {'a': 1}, db_path=db_path)
+        assert await asqlite3_jget('j', db_path=db_path) == {'a': 1}
+        await asqlite3_put_many({'x': '1', 'y': '2'}, db_path=db_path)
+        rows = await asqlite3_query('select count(*) as n from __cache__', db_path=db_path)
+        assert rows == [{'n': 5}]
+
+    asyncio.run(main())
+
+
+def test_sqlite3_write_behind(tmp_path):
+    import sqlite3
+    import threading
+    from contextlib import closing
+    from concurrent.futures import ThreadPoolExecutor
+    from qqutils.sqliteutils import sqlite3_set_write_behind, sqlite3_flush, sqlite3_query
+
+    db_path = str(tmp_path / 'write_behind.db')
+    sqlite3_put('old', 'o', db_path=db_path)
+    sqlite3_jput('both', {'a': 1}, db_path=db_path)
+    sqlite3_set_write_behind(60, db_path=db_path)
+    try:
+        assert sqlite3_put('old', 'n', db_path=db_path) == 'o'
+        assert sqlite3_put('both', 'v', db_path=db_path) is None
+        assert sqlite3_jput('both', {'b': 2}, db_path=db_path) == {'a': 1}     # pending write to the other column only
+        assert sqlite3_put('k', 'a', db_path=db_path) is None
+        assert sqlite3_put('k', 'b', db_path=db_path) == 'a'
+        assert sqlite3_jput('j', {'a': 1}, db_path=db_path) is None
+        sqlite3_delete('old', db_path=db_path)
+        assert sqlite3_get('k', db_path=db_path) == 'b'
+        assert sqlite3_jget('j', db_path=db_path) == {'a': 1}
+        assert sqlite3_get('old', db_path=db_path) is None
+        assert sorted(r['key'] for r in sqlite3_query('select key from __cache__', db_path=db_path)) == ['both', 'old']
+
+        assert sqlite3_flush(db_path) == 4
+        assert sorted(r['key'] for r in sqlite3_query('select key from __cache__', db_path=db_path)) == ['both', 'j', 'k']
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda i: sqlite3_put(f'm{i % 10}', str(i), db_path=db_path), range(200)))
+    finally:
+        sqlite3_set_write_behind(None, db_path=db_path)
+    assert len(sqlite3_query('select key from __cache__ where key like "m%"', db_path=db_path)) == 10
+
+    sqlite3_set_write_behind(0.01, max_batch=5, db_path=db_path)
+    try:
+        sqlite3_put('bg', 'x', db_path=db_path)
+        time.sleep(0.2)
+        assert sqlite3_query('select value from __cache__ where key = "bg"', db_path=db_path) == [{'value': 'x'}]
+    finally:
+        sqlite3_set_write_behind(None, db_path=db_path)
+
+    sqlite3_set_write_behind(60, db_path=db_path)
+    try:
+        sqlite3_jput('f', {'a': 1}, db_path=db_path)
+        with closing(sqlite3.connect(db_path)) as other:
+            other.execute('BEGIN IMMEDIATE')    # the flush below waits for the lock with the group in flight
+            flush = threading.Thread(target=sqlite3_flush, args=(db_path,))
+            flush.start()
+            time.sleep(0.1)
+            assert sqlite3_put('f', 'x', db_path=db_path) is None
+            assert sqlite3_jget('f', db_path=db_path) == {'a': 1}
+            other.rollback()
+        flush.join()
+    finally:
+        sqlite3_set_write_behind(None, db_path=db_path)
+    assert (sqlite3_get('f', db_path=db_path), sqlite3_jget('f', db_path=db_path)) == ('x', {'a': 1})
+
+    sqlite3_set_write_behind(60, db_path=db_path)
+    try:
+        sqlite3_put('t', 'v', db_path=db_path, ttl=0.05)
+        time.sleep(0.1)
+        assert sqlite3_jput('t', {'b': 2}, db_path=db_path) is None
+        assert sqlite3_get('t', db_path=db_path) is None       # as without write-behind
+        sqlite3_flush(db_path)
+        assert (sqlite3_get('t', db_path=db_path), sqlite3_jget('t', db_path=db_path)) == (None, {'b': 2})
+    finally:
+        sqlite3_set_write_behind(None, db_path=db_path)
+
+
+def test_sqlite3_write_behind_retry(tmp_path, monkeypatch):
+    import sqlite3
+    import qqutils.sqliteutils as sqliteutils
+    from qqutils.sqliteutils import sqlite3_set_write_behind, sqlite3_flush
+
+    db_path = str(tmp_path / 'retry.db')
+    connection = sqliteutils._connection
+    failures = []
+
+    def failing_connection(path=None):
+        if not failures:
+            failures.append(path)
+            # a write to another column of the key lands while its group is being committed
+            sqlite3_put('k', 'v', db_path=db_path)
+            raise sqlite3.OperationalError('disk I/O error')
+        return connection(path)
+
+    sqlite3_set_write_behind(60, db_path=db_path)
+    try:
+        sqlite3_jput('k', {'a': 1}, db_path=db_path)
+        monkeypatch.setattr(sqliteutils, '_connection', failing_connection)
+        assert sqlite3_flush(db_path) == 0
+        assert failures
+        assert sqlite3_jget('k', db_path=db_path) == {'a': 1}
+        assert sqlite3_flush(db_path) == 1
+    finally:
+        sqlite3_set_write_behind(None, db_path=db_path)
+    assert sqlite3_jget('k', db_path=db_path) == {'a': 1}
+    assert sqlite3_get('k', db_path=db_path) == 'v'
+
+
+def test_sharded_kv(tmp_path, capsys):
+    from qqutils.sqliteutils import ShardedKV, sqlite3_query
+
+    kv = ShardedKV(str(tmp_path / 'kv'), shards=4)
+    try:
+        assert kv.shards == 4
+        assert len({kv.shard_of(f'k{i}') for i in range(100)}) == 4
+        assert kv.shard_of('k1') == ShardedKV(str(tmp_path / 'kv'), shards=4).shard_of('k1')
+
+        assert kv.put('a', '1') is None
+        assert kv.put('a', '2') == '1'
+        assert kv.get('a') == '2'
+        assert kv.jput('j', {'x': 1}) is None
+        assert kv.jget('j') == {'x': 1}
+
+        keys = [f'k{i}' for i in range(100)]
+        assert kv.put_many({k: k for k in keys}) == [None] * 100
+        assert kv.put_many([('k3', 'x'), ('a', '3')]) == ['k3', '2']
+        assert kv.get_many(['k3', 'nope', 'k99']) == ['x', None, 'k99']
+        assert kv.jput_many({'j': {'y': 2}}) == [{'x': 1}]
+        assert kv.jget_many(['j']) == [{'y': 2}]
+        assert len(kv.jget_all()) == 102
+        counts = [sqlite3_query('select count(*) as n from __cache__', db_path=p)[0]['n'] for p in kv.paths]
+        assert sum(counts) == 102 and all(counts)
+
+        assert kv.delete_many(keys) == 100
+        kv.delete('a')
+        assert [r['key'] for r in kv.jget_all()] == ['j']
+        kv.dump()
+        assert capsys.readouterr().out.count('__cache__') == 1     # the row of 'j', empty shards print nothing
+    finally:
+        kv.close()
+
+
+def test_sqlite3_compression(tmp_path):
+    import lzma
+    from qqutils.sqliteutils import (
+        sqlite3_set_compression, sqlite3_register_codec, sqlite3_jput_many, sqlite3_jget_many, sqlite3_jget_all, sqlite3_query,
+    )
+
+    db_path = str(tmp_path / 'compression.db')
+    big = {'rows': [{'name': 'x' * 10, 'n': i % 3} for i in range(1000)]}
+    sqlite3_set_compression('zlib', threshold=1024, db_path=db_path)
+    try:
+        sqlite3_jput('small', {'a': 1}, db_path=db_path)
+        assert sqlite3_jput('big', big, db_path=db_path) is None
+        assert sqlite3_jput('big', big, db_path=db_path) == big
+        assert sqlite3_jget('big', db_path=db_path) == big
+        rows = {r['key']: r for r in sqlite3_query('select key, data, codec, length(payload) as size from __cache__', db_path=db_path)}
+        assert rows['small']['codec'] is None and rows['small']['data'] == '{"a": 1}'
+        assert rows['big']['codec'] == 'zlib' and rows['big']['data'] is None and rows['big']['size'] < 1024
+
+        sqlite3_register_codec('lzma', lzma.compress, lzma.decompress)
+        sqlite3_set_compression('lzma', threshold=1024, db_path=db_path)
+        sqlite3_jput_many({'big2': big}, db_path=db_path)
+        assert sqlite3_jget_many(['big', 'big2', 'small'], db_path=db_path) == [big, big, {'a': 1}]
+        assert {r['key']: json.loads(r['data']) for r in sqlite3_jget_all(db_path=db_path)}['big2'] == big
+
+        sqlite3_put('big', 'v', db_path=db_path)
+        assert sqlite3_jget('big', db_path=db_path) == big
+    finally:
+        sqlite3_set_compression(None, db_path=db_path)
+
+
+def test_sqlite3_serializer(tmp_path):
+    import datetime
+    import pytest
+    from qqutils.sqliteutils import (
+        sqlite3_set_serializer, sqlite3_register_serializer, sqlite3_set_compression, sqlite3_jput_many, sqlite3_jget_many,
+        sqlite3_jget_all, sqlite3_query,
+    )
+
+    db_path = str(tmp_path / 'serializer.db')
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    assert sqlite3_jput('p', {'at': now, 'raw': b'\x00\x01'}, db_path=db_path, serializer='pickle') is None
+    assert sqlite3_jget('p', db_path=db_path) == {'at': now, 'raw': b'\x00\x01'}
+    sqlite3_jput('m', {'t': (1, 2), 's': {3}}, db_path=db_path, serializer='marshal')
+    assert sqlite3_jget('m', db_path=db_path) == {'t': (1, 2), 's': {3}}
+    with pytest.raises(ValueError):
+        sqlite3_jput('x', {}, db_path=db_path, serializer='nope')
+
+    sqlite3_register_serializer('upper', lambda obj: obj.upper().encode(), lambda b: b.decode().lower())
+    sqlite3_set_serializer('upper', db_path=db_path)
+    sqlite3_set_compression('zlib', threshold=100, db_path=db_path)
+    try:
+        sqlite3_jput_many({'u': 'abc', 'big': 'y' * 1000}, db_path=db_path)
+        assert sqlite3_jput('j', {'a': 1}, db_path=db_path, serializer='json') is None
+        assert sqlite3_jget_many(['p', 'm', 'u', 'big', 'j'], db_path=db_path) == [
+            {'at': now, 'raw': b'\x00\x01'}, {'t': (1, 2), 's': {3}}, 'abc', 'y' * 1000, {'a': 1},
+        ]
+        rows = {r['key']: r for r in sqlite3_query('select key, data, codec, serializer from __cache__', db_path=db_path)}
+        assert (rows['p']['serializer'], rows['m']['serializer'], rows['u']['serializer']) == ('pickle', 'marshal', 'upper')
+        assert rows['big']['codec'] == 'zlib' and rows['j']['serializer'] is None and rows['j']['data'] == '{"a": 1}'
+        assert {r['key']: r['payload'] for r in sqlite3_jget_all(db_path=db_path)}['big'] == b'Y' * 1000
+
+        assert sqlite3_jput('p', {'b': 2}, db_path=db_path, serializer='json') == {'at': now, 'raw': b'\x00\x01'}
+        assert sqlite3_jget('p', db_path=db_path) == {'b': 2}
+    finally:
+        sqlite3_set_serializer(None, db_path=db_path)
+        sqlite3_set_compression(None, db_path=db_path)
+
+
+def test_sqlite3_scan(tmp_path):
+    from qqutils.sqliteutils import sqlite3_scan, sqlite3_put_many, sqlite3_query, ShardedKV
+
+    db_path = str(tmp_path / 'scan.db')
+    keys = [f'tenant:{t}:user:{u}' for t in (1, 12, 2) for u in range(3)]
+    sqlite3_put_many({k: k.upper() for k in keys}, db_path=db_path)
+    sqlite3_jput('tenant:1:meta', {'n': 3}, db_path=db_path)
+    sqlite3_put('tenant:1:gone', 'x', db_path=db_path, ttl=-1)
+
+    assert list(sqlite3_scan('tenant:1:', db_path=db_path)) == ['tenant:1:meta'] + [f'tenant:1:user:{u}' for u in range(3)]
+    assert list(sqlite3_scan('tenant:1:user:', reverse=True, limit=2, db_path=db_path)) == ['tenant:1:user:2', 'tenant:1:user:1']
+    assert list(sqlite3_scan('tenant:2:', column='value', db_path=db_path))[0] == ('tenant:2:user:0', 'TENANT:2:USER:0')
+    assert list(sqlite3_scan('tenant:1:m', column='data', db_path=db_path)) == [('tenant:1:meta', {'n': 3})]
+    assert list(sqlite3_scan(start='tenant:12:', end='tenant:1:', db_path=db_path)) == [f'tenant:12:user:{u}' for u in range(3)]
+    assert list(sqlite3_scan('tenant:2:', end='tenant:1', db_path=db_path)) == []
+    assert len(list(sqlite3_scan(db_path=db_path))) == 10
+    sqlite3_put_many({'a\ud7ff:x': '1', 'a\ue000': '2'}, db_path=db_path)
+    assert list(sqlite3_scan('a\ud7ff', db_path=db_path)) == ['a\ud7ff:x']
+
+    sqlite3_put_many({f'del:{i:04}': 'x' for i in range(1500)}, db_path=db_path)
+    assert list(sqlite3_scan('del:', reverse=True, limit=20, batch_size=7, db_path=db_path)) == [f'del:{i:04}' for i in range(1499, 1479, -1)]
+    for key in sqlite3_scan('del:', db_path=db_path):     # writing while scanning, more keys than one page
+        sqlite3_delete(key, db_path=db_path)
+    assert list(sqlite3_scan('del:', db_path=db_path)) == []
+
+    plan = sqlite3_query(
+        "explain query plan select key from __cache__ where key >= 'a' and key < 'b' order by key", db_path=db_path,
+    )
+    assert 'USING' in plan[0]['detail'] and 'key>?' in plan[0]['detail']
+
+    kv = ShardedKV(str(tmp_path / 'scan'), shards=3)
+    try:
+        kv.put_many({k: k for k in keys})
+        assert list(kv.scan('tenant:12:', column='value')) == [(f'tenant:12:user:{u}',) * 2 for u in range(3)]
+        assert list(kv.scan('tenant:', reverse=True, limit=4)) == sorted(keys, reverse=True)[:4]
+    finally:
+        kv.close()
+
+
+def test_sqlite3_negative_cache(tmp_path):
+    import sqlite3
+    import threading
+    from contextlib import closing
+    from qqutils.sqliteutils import (
+        sqlite3_set_negative_cache, sqlite3_negative_cache_info, sqlite3_put_many, sqlite3_get_many, sqlite3_delete_many,
+        sqlite3_execute, sqlite3_set_write_behind, sqlite3_flush,
+    )
+
+    db_path = str(tmp_path / 'negative.db')
+    sqlite3_put_many({f'k{i}': str(i) for i in range(500)}, db_path=db_path)
+    sqlite3_set_negative_cache(0.01, db_path=db_path)
+    try:
+        assert sqlite3_get_many([f'k{i}' for i in range(500)], db_path=db_path) == [str(i) for i in range(500)]
+        assert sqlite3_get_many([f'x{i}' for i in range(1000)], db_path=db_path) == [None] * 1000
+        info = sqlite3_negative_cache_info(db_path=db_path)
+        assert info['rebuilds'] == 1 and info['keys'] == 500 and info['lookups'] == 1500
+        assert info['skips'] + info['false_positives'] == 1000 and info['fp_rate'] < 0.05
+        assert info['skip_rate'] == info['skips'] / 1500
+
+        sqlite3_put('new', 'v', db_path=db_path)
+        sqlite3_jput('newj', {'a': 1}, db_path=db_path)
+        assert sqlite3_get('new', db_path=db_path) == 'v' and sqlite3_jget('newj', db_path=db_path) == {'a': 1}
+
+        assert sqlite3_get('other', db_path=db_path) is None
+        with closing(sqlite3.connect(db_path)) as other:      # e.g. another process
+            other.execute("insert into __cache__ (key, value) values ('other', 'o')")
+            other.commit()
+        assert sqlite3_get('other', db_path=db_path) == 'o'
+        thread = threading.Thread(target=sqlite3_put_many, args=({f't{i}': 't' for i in range(50)},), kwargs={'db_path': db_path})
+        thread.start()
+        thread.join()
+        assert sqlite3_get('t49', db_path=db_path) == 't'
+        assert sqlite3_negative_cache_info(db_path=db_path)['rebuilds'] == 1     # caught up, not rebuilt
+
+        assert sqlite3_delete_many([f'k{i}' for i in range(200)], db_path=db_path) == 200
+        assert sqlite3_get('k1', db_path=db_path) is None
+        assert sqlite3_negative_cache_info(db_path=db_path)['rebuilds'] == 2     # after the deletes
+
+        sqlite3_execute("insert into __cache__ (key, value) values ('raw', 'r')", db_path=db_path)
+        assert sqlite3_get('raw', db_path=db_path) == 'r'
+
+        sqlite3_set_write_behind(10, db_path=db_path)
+        try:
+            sqlite3_put('pending', 'p', db_path=db_path)
+            sqlite3_execute('select 1', db_path=db_path)     # drop the filter while the write is pending
+            assert sqlite3_get('missing', db_path=db_path) is None
+            sqlite3_put('a', 'v1', db_path=db_path)
+            sqlite3_delete('a', db_path=db_path)
+            sqlite3_put('a', 'v2', db_path=db_path)      # pending as delete-then-put
+            sqlite3_execute('select 1', db_path=db_path)
+            assert sqlite3_get('missing', db_path=db_path) is None
+            sqlite3_flush(db_path=db_path)
+            assert sqlite3_get('a', db_path=db_path) == 'v2'
+        finally:
+            sqlite3_set_write_behind(None, db_path=db_path)
+        assert sqlite3_get('pending', db_path=db_path) == 'p'
+    finally:
+        sqlite3_set_negative_cache(None, db_path=db_path)
+    assert sqlite3_negative_cache_info(db_path=db_path) == {}
+
+
+def test_sqlite_queue(tmp_path):
+    import queue
+    import sqlite3
+    import threading
+    from contextlib import closing
+    import pytest
+    from qqutils.sqliteutils import SqliteQueue
+
+    db_path = str(tmp_path / 'queue.db')
+    q = SqliteQueue('jobs', db_path=db_path, visibility_timeout=0.2, poll_interval=0.01)
+    q.put({'n': 'low'})
+    q.put({'n': 'high'}, priority=5)
+    q.put({'n': 'later'}, priority=9, delay=60)
+    assert len(q) == 3 and len(SqliteQueue('other', db_path=db_path)) == 0
+
+    high = q.get()
+    assert (high.data, high.attempts) == ({'n': 'high'}, 1)
+    low = q.get(block=False)
+    assert low.data == {'n': 'low'}
+    with pytest.raises(queue.Empty):
+        q.get(block=False)
+    assert q.nack(low) == 1
+    assert q.get(timeout=1).id == low.id
+
+    time.sleep(0.25)    # both claims time out
+    again = q.get_many(10, block=False)
+    assert [(i.data['n'], i.attempts) for i in again] == [('high', 2), ('low', 3)]
+    assert q.ack(high, low) == 0        # stale receipts
+    assert q.ack(*again) == 2 and len(q) == 1
+
+    start = time.monotonic()
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+    with closing(sqlite3.connect(db_path, timeout=0, isolation_level=None)) as writer:
+        writer.execute('BEGIN IMMEDIATE')      # polling an empty queue does not wait for the write lock
+        with pytest.raises(queue.Empty):
+            q.get(block=False)
+        writer.rollback()
+    threading.Timer(0.05, q.put, ({'n': 'wake'},)).start()
+    assert q.get(timeout=2).data == {'n': 'wake'}
+
+    q.clear()
+    q.visibility_timeout = 30
+    q.put_many(range(200))
+    seen = []
+
+    def consume():
+        consumer = SqliteQueue('jobs', db_path=db_path, poll_interval=0.01)
+        while True:
+            try:
+                items = consumer.get_many(7, timeout=0.1)
+            except queue.Empty:
+                return
+            seen.extend(i.data for i in items)
+            consumer.ack(*items)
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(seen) == list(range(200)) and len(q) == 0
+
+
+def test_sqlite3_search(tmp_path):
+    import pytest
+    from qqutils.sqliteutils import sqlite3_fts_index, sqlite3_search, sqlite3_query
+
+    db_path = str(tmp_path / 'fts.db')
+    sqlite3_jput('d1', {'title': 'SQLite full text search', 'body': 'FTS5 ranks documents with bm25'}, db_path=db_path)
+    sqlite3_jput('d2', {'title': 'Bloom filters', 'body': 'probabilistic sets, no search here'}, db_path=db_path)
+    with pytest.raises(ValueError):
+        sqlite3_search('search', db_path=db_path)
+
+    sqlite3_fts_index(['$.title', '$.body'], db_path=db_path)
+    results = sqlite3_search('search', db_path=db_path)
+    assert sorted(r['key'] for r in results) == ['d1', 'd2'] and results[0]['rank'] <= results[1]['rank']
+    assert {r['key']: r['data'] for r in results}['d1']['title'] == 'SQLite full text search'
+    assert [r['key'] for r in sqlite3_search('"$.title": bloom', db_path=db_path)] == ['d2']
+    hl = sqlite3_search('bm25 OR rank*', highlight=('<b>', '</b>'), db_path=db_path)[0]['highlights']
+    assert hl == {'$.title': 'SQLite full text search', '$.body': 'FTS5 <b>ranks</b> documents with <b>bm25</b>'}
+
+    sqlite3_jput('d2', {'title': 'Cuckoo filters'}, db_path=db_path)
+    sqlite3_jput('d3', {'title': 'Search engines'}, db_path=db_path)
+    sqlite3_delete('d1', db_path=db_path)
+    sqlite3_put('d4', 'not json', db_path=db_path)
+    assert [r['key'] for r in sqlite3_search('search OR bloom', db_path=db_path)] == ['d3']
+    sqlite3_jput('d5', {'title': 'search me'}, db_path=db_path, ttl=-1)
+    assert [r['key'] for r in sqlite3_search('search', db_path=db_path)] == ['d3']
+
+    sqlite3_fts_index(['$.title', '$.body'], db_path=db_path)     # no-op
+    sqlite3_fts_index(['value'], db_path=db_path)
+    assert [r['key'] for r in sqlite3_search('json', db_path=db_path)] == ['d4']
+    sqlite3_fts_index(None, db_path=db_path)
+    assert not sqlite3_query("select name from sqlite_master where name like '__cache_fts%'", db_path=db_path)
+    sqlite3_jput('d6', {'title': 'still writable'}, db_path=db_path)